@@ -0,0 +1,117 @@
+"""
+Loads avatars for the board without ever blocking the GTK main loop.
+
+Downloads and decoding happen on background threads, widgets get a
+placeholder until the picture arrives, and pictures that have already been
+scaled are kept in memory so rebuilding a widget costs nothing.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import os
+import threading
+import time
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from gi.repository import GdkPixbuf, GLib, Gtk
+
+from cache import LRUCache
+
+
+class AvatarLoader(object):
+    def __init__(self, cache_dir, max_age=7 * 24 * 60 * 60, workers=2,
+                 cache_size=256):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.pixbufs = LRUCache(maxsize=cache_size)
+        # Callbacks waiting on each (url, size), only touched on the main loop.
+        self.waiting = dict()
+        self.queue = Queue()
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def image(self, url, scale=1):
+        """A Gtk.Image of the avatar at `url`, `scale` * 100 pixels square.
+
+        If the avatar isn't in memory yet, the image shows a placeholder
+        until it has been loaded.
+        """
+        size = int(scale * 100)
+        pixbuf = self.pixbufs.get((url, size), None)
+        if pixbuf:
+            return Gtk.Image.new_from_pixbuf(pixbuf)
+
+        image = Gtk.Image.new_from_icon_name('avatar-default',
+                                             Gtk.IconSize.DIALOG)
+        image.set_pixel_size(size)
+        self.load(url, size, image.set_from_pixbuf)
+        return image
+
+    def load(self, url, size, callback):
+        """Call `callback` on the main loop with the scaled avatar."""
+        key = (url, size)
+        if key in self.waiting:
+            self.waiting[key].append(callback)
+            return
+        self.waiting[key] = [callback]
+        self.queue.put(key)
+
+    def path(self, url):
+        """Where the avatar at `url` is kept on disk."""
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def _work(self):
+        # Imported here, since github brings in the DB as well, which the
+        # window shouldn't have to wait for.
+        from github import make_session
+        session = make_session(pool_size=1)
+        while True:
+            url, size = self.queue.get()
+            pixbuf = None
+            try:
+                path = self._fetch(url, session)
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+                    path, size, size, False)
+            except Exception as e:
+                logging.error("Could not load avatar {0}: {1}".format(url, e))
+            GLib.idle_add(self._deliver, (url, size), pixbuf)
+
+    def _fetch(self, url, session):
+        path = self.path(url)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            age = None
+        if age is not None and age < self.max_age:
+            return path
+
+        try:
+            r = session.get(url, timeout=30)
+            r.raise_for_status()
+        except Exception:
+            if age is not None:
+                # An old picture beats no picture.
+                return path
+            raise
+
+        # Write somewhere else first so a half-written file is never read.
+        partial = '{0}.{1}'.format(path, threading.current_thread().ident)
+        with open(partial, 'wb') as image_file:
+            image_file.write(r.content)
+        os.rename(partial, path)
+        return path
+
+    def _deliver(self, key, pixbuf):
+        callbacks = self.waiting.pop(key, [])
+        if pixbuf:
+            self.pixbufs.put(key, pixbuf)
+            for callback in callbacks:
+                callback(pixbuf)
+        return False
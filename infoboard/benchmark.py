@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+"""
+Measures the scraper and the board against a made-up organization, without
+talking to Github at all.
+
+A `FakeGithub` stands in for the requests session `Github` uses and answers
+from a `SyntheticOrg`, with ETags and rate limit headers like the real API.
+Two benchmarks are run:
+
+  scrape    times scraper cycles, counting API calls and DB commits, with
+            a little new activity in the organization between cycles.
+  queries   fills a DB with each of the `--events` sizes, then times
+            recent_events, top_contributions and building the board.
+
+Results are printed as JSON, so runs can be saved and compared:
+
+    python benchmark.py --events 10000,100000 --output before.json
+
+Filling a DB takes much longer than anything it measures, so `--db-dir`
+keeps the filled DBs around to be reused by later runs.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+from datetime import datetime, timedelta
+from hashlib import sha1
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+try:
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from sqlalchemy import event as sqlalchemy_event
+from knowledge.model import DBSession
+
+from github import Github
+from httpcache import ValidatorCache
+from scheduler import Scheduler
+from schema import Event
+import data
+import scraper
+import viewmodel
+
+# Relative frequency of each type of event, roughly as Github serves them.
+EVENT_MIX = {
+    'PushEvent': 50,
+    'CreateEvent': 10,
+    'IssueCommentEvent': 10,
+    'IssuesEvent': 6,
+    'PullRequestEvent': 6,
+    'WatchEvent': 6,
+    'DeleteEvent': 3,
+    'ForkEvent': 2,
+    'GollumEvent': 2,
+    'CommitCommentEvent': 1,
+    'PullRequestReviewCommentEvent': 1,
+    'MemberEvent': 1,
+    'FollowEvent': 1,
+    'GistEvent': 1,
+}
+
+# How many events Github keeps in a user's feed, and an organization's.
+FEED_LENGTH = 30
+ORG_FEED_LENGTH = 300
+
+# Events are cached this many at a time when filling a DB.
+BATCH_SIZE = 1000
+
+
+class SyntheticOrg(object):
+    """An organization of `members` members working on `repos` repositories,
+       whose events are made up on demand.
+    """
+    def __init__(self, name='BenchOrg', members=50, repos=20, mix=None,
+                 seed=0):
+        self.name = name
+        self.random = random.Random(seed)
+        self.mix = sorted((mix or EVENT_MIX).items())
+        self.owner = self._user(0, name)
+        self.members = [self._user(i, 'member{0}'.format(i))
+                        for i in range(1, members + 1)]
+        self.repos = dict()
+        for i in range(repos):
+            repo = dict(name='repo{0}'.format(i),
+                        full_name='{0}/repo{1}'.format(name, i),
+                        html_url='https://github.com/{0}/repo{1}'
+                                 .format(name, i),
+                        description='Synthetic repository {0}'.format(i),
+                        owner=self.owner)
+            self.repos[repo['full_name']] = repo
+        self.feeds = dict((member['login'], []) for member in self.members)
+        self.org_feed = []
+        self.next_id = 1
+
+    def _user(self, i, login):
+        return dict(id=i, login=login,
+                    avatar_url='https://avatars.example.com/u/{0}'.format(i))
+
+    def generate(self, count, spread=timedelta(days=7), now=None):
+        """Make up `count` events from the last `spread`, and add them to the
+           feeds.  Returns them oldest first.
+        """
+        now = now or datetime.utcnow()
+        seconds = spread.total_seconds()
+        times = sorted(now - timedelta(seconds=self.random.random() * seconds)
+                       for _ in range(count))
+        events = [self._event(created_at) for created_at in times]
+
+        for event in events:
+            feed = self.feeds[event['actor']['login']]
+            feed.insert(0, event)
+            del feed[FEED_LENGTH:]
+            self.org_feed.insert(0, event)
+        del self.org_feed[ORG_FEED_LENGTH:]
+        return events
+
+    def _event(self, created_at):
+        event_id = self.next_id
+        self.next_id += 1
+        actor = self.random.choice(self.members)
+        repo = self.repos[self.random.choice(sorted(self.repos))]
+        event_type = self._type()
+        return dict(id='{0}'.format(event_id),
+                    type=event_type,
+                    actor=actor,
+                    repo=dict(name=repo['full_name']),
+                    payload=self._payload(event_type, event_id),
+                    created_at=created_at.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def _type(self):
+        pick = self.random.random() * sum(weight for _, weight in self.mix)
+        for event_type, weight in self.mix:
+            pick -= weight
+            if pick < 0:
+                return event_type
+        return self.mix[-1][0]
+
+    def _payload(self, event_type, event_id):
+        member = self.random.choice(self.members)
+        number = self.random.randint(1, 500)
+        payload = dict()
+        if event_type == 'PushEvent':
+            payload['commits'] = [
+                dict(sha=sha1('{0}.{1}'.format(event_id, i).encode('utf-8'))
+                         .hexdigest(),
+                     message='Change number {0} of event {1}'
+                             .format(i, event_id),
+                     distinct=self.random.random() < 0.9,
+                     author=dict(name=member['login'],
+                                 email='{0}@example.com'
+                                       .format(member['login'])))
+                for i in range(self.random.randint(1, 20))]
+        elif event_type in ['CreateEvent', 'DeleteEvent']:
+            payload['ref_type'] = self.random.choice(['branch', 'tag'])
+            payload['ref'] = 'ref-{0}'.format(event_id)
+        elif event_type == 'ForkEvent':
+            payload['forkee'] = dict(full_name='{0}/fork{1}'
+                                     .format(member['login'], event_id))
+        elif event_type == 'GollumEvent':
+            payload['pages'] = [dict(title='Page {0}'.format(i))
+                                for i in range(self.random.randint(1, 3))]
+        elif event_type == 'MemberEvent':
+            payload['member'] = member
+        elif event_type == 'FollowEvent':
+            payload['target'] = member
+        elif event_type in ['IssuesEvent', 'PullRequestEvent']:
+            payload['action'] = self.random.choice(['opened', 'closed'])
+            payload['number'] = number
+        elif event_type in ['WatchEvent', 'GistEvent']:
+            payload['action'] = 'started' if event_type == 'WatchEvent' \
+                                else 'create'
+
+        if 'Issue' in event_type:
+            payload['issue'] = dict(id=number, number=number,
+                                    title='Issue number {0}'.format(number))
+        if 'Comment' in event_type:
+            payload['comment'] = dict(id=event_id,
+                                      body='Comment on event {0}. '
+                                           .format(event_id) * 10)
+        return payload
+
+
+class FakeGithub(object):
+    """Answers `Github`'s requests from a `SyntheticOrg`, like the API would.
+
+    Responses carry ETags, and conditional requests for unchanged resources
+    get a 304 that doesn't count against the rate limit.  Every request is
+    counted by status.
+    """
+    def __init__(self, org, limit=5000, latency=0):
+        self.org = org
+        self.auth = None
+        self.headers = dict()
+        self.limit = limit
+        self.remaining = limit
+        self.reset = int(time.time()) + 3600
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.bytes = 0
+
+    def get(self, url, headers=None, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(url)
+        query = parse_qs(url.query)
+        status, payload = self._route(url.path.strip('/').split('/'), query)
+        body = json.dumps(payload).encode('utf-8')
+        etag = '"{0}"'.format(sha1(body).hexdigest())
+
+        with self.lock:
+            if (headers or dict()).get('If-None-Match') == etag:
+                status, body = 304, b''
+            elif self.remaining <= 0:
+                status = 403
+                body = json.dumps(dict(message='API rate limit exceeded')) \
+                           .encode('utf-8')
+            else:
+                self.remaining -= 1
+            self.calls[status] = self.calls.get(status, 0) + 1
+            self.bytes += len(body)
+
+            response = requests.Response()
+            response.status_code = status
+            response.url = url.geturl()
+            response._content = body
+            response.headers = CaseInsensitiveDict({
+                'ETag': etag,
+                'X-RateLimit-Limit': '{0}'.format(self.limit),
+                'X-RateLimit-Remaining': '{0}'.format(self.remaining),
+                'X-RateLimit-Reset': '{0}'.format(self.reset),
+                'X-Poll-Interval': '60',
+            })
+        return response
+
+    def _route(self, path, query):
+        org = self.org
+        if path == ['orgs', org.name, 'members']:
+            return 200, org.members
+        if path == ['orgs', org.name, 'events'] or \
+           path[2:] == ['events', 'orgs', org.name]:
+            per_page = int(query.get('per_page', [30])[0])
+            page = int(query.get('page', [1])[0])
+            return 200, org.org_feed[(page - 1) * per_page:page * per_page]
+        if len(path) == 3 and path[0] == 'users' and path[2] == 'events' \
+           and path[1] in org.feeds:
+            return 200, org.feeds[path[1]]
+        if len(path) == 3 and path[0] == 'repos':
+            repo = org.repos.get('/'.join(path[1:]))
+            if repo:
+                return 200, repo
+        return 404, dict(message='Not Found')
+
+    def stats(self):
+        with self.lock:
+            calls = dict(self.calls)
+            return dict(calls=sum(calls.values()),
+                        by_status=dict(('{0}'.format(status), count)
+                                       for status, count in calls.items()),
+                        bytes=self.bytes,
+                        rate_remaining=self.remaining)
+
+    def clear_stats(self):
+        with self.lock:
+            self.calls = dict()
+            self.bytes = 0
+
+
+class CommitCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        sqlalchemy_event.listen(engine, 'commit', self.commit)
+
+    def commit(self, connection):
+        self.count += 1
+
+
+def open_db(path):
+    """Point `data` at the SQLite DB at `path`, forgetting the last one."""
+    DBSession.remove()
+    data.entity_cache.clear()
+    engine = data.setup('sqlite:///{0}'.format(path))
+    data.migrate(engine)
+    return engine
+
+
+def timed(function, repeat, before=None):
+    """Call `function` `repeat` times, returning statistics in seconds."""
+    times = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    times.sort()
+    return dict(min=times[0], median=times[len(times) // 2],
+                mean=sum(times) / len(times), repeat=repeat)
+
+
+def bench_scrape(options, workdir):
+    """Run scraper cycles against a fake organization."""
+    org = SyntheticOrg(members=options.members, repos=options.repos,
+                       mix=options.mix, seed=options.seed)
+    org.generate(options.members * FEED_LENGTH)
+
+    engine = open_db(os.path.join(workdir, 'scrape.db'))
+    commits = CommitCounter(engine)
+    fake = FakeGithub(org, latency=options.latency)
+    client = Github(cache=ValidatorCache(), session=fake)
+    scheduler = Scheduler()
+
+    results = []
+    for cycle in range(options.cycles):
+        if cycle:
+            org.generate(options.activity, spread=timedelta(minutes=5))
+        fake.clear_stats()
+        commits.count = 0
+        start = time.time()
+        if options.mode == 'organization':
+            scraper.cache_org_events(client, org.name, scheduler,
+                                     workers=options.workers)
+        else:
+            scraper.cache_events(client, org.name, workers=options.workers)
+        result = dict(cycle=cycle, seconds=time.time() - start,
+                      commits=commits.count)
+        result.update(fake.stats())
+        results.append(result)
+    return results
+
+
+def bench_queries(options, workdir, size):
+    """Time the board's queries against a DB of `size` events."""
+    db_dir = options.db_dir or workdir
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+    path = os.path.join(db_dir, 'events-{0}-{1}.db'.format(size, options.seed))
+    engine = open_db(path)
+    result = dict(events=size)
+
+    stored = DBSession.query(Event).count()
+    if stored != size:
+        result['fill'] = fill_db(options, size - stored)
+    result['db_bytes'] = os.path.getsize(path)
+
+    commits = CommitCounter(engine)
+    cold = data.entity_cache.clear
+    for name, function in [
+            ('recent_events',
+             lambda: data.recent_events(limit=options.board_events)),
+            ('top_contributions',
+             lambda: data.top_contributions(options.board_users,
+                                            options.board_repos)),
+            ('build_snapshot',
+             lambda: viewmodel.build_snapshot(options.board_events,
+                                              options.board_users,
+                                              options.board_repos))]:
+        result[name] = dict(cold=timed(function, options.repeat, cold),
+                            warm=timed(function, options.repeat))
+    result['commits'] = commits.count
+    return result
+
+
+def fill_db(options, count):
+    """Cache `count` made-up events from the last fortnight, so about half
+       of them count towards top_contributions.
+    """
+    org = SyntheticOrg(members=options.members, repos=options.repos,
+                       mix=options.mix, seed=options.seed)
+    # Carry on from any events already stored.
+    org.next_id = DBSession.query(Event).count() + 1
+    start = time.time()
+    data.ingest_repos(org.repos.values())
+    for done in range(0, count, BATCH_SIZE):
+        data.ingest_events(org.generate(min(BATCH_SIZE, count - done),
+                                        spread=timedelta(days=14)))
+    data.entity_cache.clear()
+    seconds = time.time() - start
+    return dict(seconds=seconds, events_per_second=count / seconds)
+
+
+def parse_mix(text):
+    mix = dict()
+    for item in text.split(','):
+        event_type, _, weight = item.partition('=')
+        mix[event_type.strip()] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('benchmarks', nargs='*', default=['scrape', 'queries'],
+                        help="which benchmarks to run (scrape, queries)")
+    parser.add_argument('--members', type=int, default=50)
+    parser.add_argument('--repos', type=int, default=20)
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help="event types and weights, e.g. "
+                             "PushEvent=5,WatchEvent=1")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cycles', type=int, default=5,
+                        help="scraper cycles to run")
+    parser.add_argument('--activity', type=int, default=20,
+                        help="new events between scraper cycles")
+    parser.add_argument('--mode', choices=['members', 'organization'],
+                        default='members')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds the fake API takes to answer")
+    parser.add_argument('--events', default='10000',
+                        help="comma separated DB sizes to time queries at")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--board-events', type=int, default=20)
+    parser.add_argument('--board-users', type=int, default=3)
+    parser.add_argument('--board-repos', type=int, default=3)
+    parser.add_argument('--db-dir', help="keep filled DBs here for reuse")
+    parser.add_argument('--output', help="write results here, not stdout")
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='infoboard-benchmark-')
+    results = dict(started=datetime.utcnow().isoformat() + 'Z',
+                   python=sys.version.split()[0],
+                   options=vars(options))
+    try:
+        if 'scrape' in options.benchmarks:
+            results['scrape'] = bench_scrape(options, workdir)
+        if 'queries' in options.benchmarks:
+            results['queries'] = [bench_queries(options, workdir, int(size))
+                                  for size in options.events.split(',')]
+    finally:
+        DBSession.remove()
+        shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
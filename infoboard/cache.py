@@ -0,0 +1,61 @@
+"""A small in-process cache, shared by the scraper and the frontends."""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import threading
+import time
+
+# Returned by `LRUCache.get` on a miss when no other default is given, so
+# that None can be cached like any other value.
+MISSING = object()
+
+
+class LRUCache(object):
+    """A bounded, thread-safe mapping that forgets the least recently used
+       entries first, and anything older than `ttl` seconds if one is given.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                stored, value = entry
+                if self.ttl is None or time.time() - stored < self.ttl:
+                    # Re-insert to mark it as most recently used.
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            ratio = float(self.hits) / total if total else 0.0
+            return dict(hits=self.hits, misses=self.misses, ratio=ratio,
+                        size=len(self.entries), maxsize=self.maxsize)
@@ -4,143 +4,1096 @@ wrap the actual work so that the data returned can get cached in Knowledge.
 """
 from __future__ import unicode_literals
 
-from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from itertools import chain
+import json
 import logging
+import zlib
+from xml.sax.saxutils import unescape
 
-from knowledge.model import DBSession, Entity
+from sqlalchemy import create_engine, func, inspect
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+from knowledge.model import DBSession, Entity, Fact, init_model, metadata
 
+from cache import LRUCache, MISSING
+import metrics
+from schema import (CachedResponse, Change, Contribution, Event, Payload,
+                    Rollup, State, entity_name_index)
 
+# SQLite refuses statements with more than 999 parameters.
+CHUNK_SIZE = 500
+
+# How far back top_contributions looks.
+CONTRIBUTION_WINDOW = timedelta(days=7)
+
+# Social (non-coding) events carry less weight
+SOCIAL_EVENTS = ['CommitCommentEvent', 'FollowEvent', 'IssueCommentEvent',
+                 'WatchEvent', 'PullRequestReviewCommentEvent',]
+
+# Bump whenever render_record changes, so old records get rebuilt.
+RENDER_VERSION = 2
+
+# How much of a comment is kept for display.
+COMMENT_EXCERPT = 280
+
+# How fetch times are kept in the state table; sorts in time order.
+FETCHED_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# How long the change log is kept for frontends to catch up on.
+CHANGE_LOG_AGE = timedelta(days=1)
+
+# Entities already looked up in this process.  Anything cached here is
+# dropped as soon as the ingest functions write it; the TTL bounds how long
+# changes made by another process (i.e. the scraper) can go unnoticed.
+entity_cache = LRUCache(maxsize=4096, ttl=300)
+
+
+def setup(db_uri, cache_size=None):
+    """Connect to the DB, creating any tables it doesn't have yet.
+
+    This is all the frontends do before reading it; bringing anything else
+    up to date is left to the scraper, through `migrate`.
+    """
+    engine = create_engine(db_uri)
+    sqlalchemy_event.listen(engine, 'commit', _count_commit)
+    init_model(engine)
+    # Cached entities would otherwise be reloaded after every commit.
+    DBSession.configure(expire_on_commit=False)
+    metadata.create_all(engine)
+    if cache_size:
+        entity_cache.maxsize = int(cache_size)
+    return engine
+
+
+def migrate(engine):
+    """Bring a DB left by an older version up to date.
+
+    Only the scraper, the one process that writes to the DB, runs this,
+    when it starts and before it adds anything.  Most of it only does
+    anything the first time.
+    """
+    upgrade(engine)
+    index_events()
+    compact_payloads()
+    unescape_facts()
+    backfill_rollups()
+    rerender_events()
+    rebuild_contributions()
+
+
+def _count_commit(connection):
+    metrics.count('infoboard_db_commits_total')
+
+
+def upgrade(engine):
+    """Bring tables created by older versions up to date.
+
+    `create_all` only creates missing tables, so columns and indexes added
+    to existing ones since are created here.
+    """
+    inspector = inspect(engine)
+    for table in [Event.__table__]:
+        columns = [column['name']
+                   for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in columns:
+                logging.info("Adding {0}.{1}".format(table.name, column.name))
+                engine.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect)))
+
+    # Older change logs may reuse sequence numbers; it only needs to last a
+    # day, so it is simply started over.
+    table = Change.__table__
+    if engine.dialect.name == 'sqlite' and table.name in \
+            inspector.get_table_names():
+        sql = engine.execute("SELECT sql FROM sqlite_master WHERE name = ?",
+                             table.name).scalar()
+        if 'AUTOINCREMENT' not in sql.upper():
+            logging.info("Recreating {0}".format(table.name))
+            table.drop(engine)
+            table.create(engine)
+
+    # Knowledge doesn't index entity names, but every lookup is by name.
+    for table, indexes in [(Entity.__table__, [entity_name_index]),
+                           (Event.__table__, Event.__table__.indexes)]:
+        existing = [index['name']
+                    for index in inspector.get_indexes(table.name)]
+        for index in indexes:
+            if index.name not in existing:
+                logging.info("Creating {0}, this may take a while"
+                             .format(index.name))
+                index.create(engine)
+
+
+def index_events():
+    """Add any cached events missing from the events table.
+
+    Databases from before the table existed are indexed the first time they
+    are opened; after that `event_info` keeps it up to date.
+    """
+    events = DBSession.query(Entity) \
+                      .filter(Entity.name.startswith('event\_', escape='\\'))
+    if events.count() == DBSession.query(Event).count():
+        return
+
+    indexed = set(name for name, in DBSession.query(Event.name))
+    count = 0
+    for entity in events:
+        if entity.name not in indexed:
+            DBSession.add(_event_row(entity))
+            count += 1
+    if count:
+        logging.info("Indexed {0} existing events".format(count))
+    DBSession.commit()
+
+
+def compact_payloads():
+    """Move the full payloads of events cached by older versions out of their
+       entities, leaving only the parts infoboard uses.
+
+    The space they took is only given back by VACUUM; see `optimize`.
+    """
+    if DBSession.query(Payload).count() >= DBSession.query(Event).count():
+        return
+
+    stored = set(name for name, in DBSession.query(Payload.name))
+    names = [name for name, in DBSession.query(Event.name)
+             if name not in stored]
+    for start in range(0, len(names), CHUNK_SIZE):
+        chunk = names[start:start + CHUNK_SIZE]
+        for event in _entity_query().filter(Entity.name.in_(chunk)):
+            payload = event['payload']
+            DBSession.add(Payload(name=event.name, data=_pack(payload)))
+            event[u'payload'] = compact_payload(payload)
+        DBSession.commit()
+        forget(chunk)
+        logging.info("Compacted {0} payloads".format(start + len(chunk)))
+
+
+def unescape_facts():
+    """Undo the HTML escaping older versions applied to everything read from
+       Github, now that text is only escaped when it is drawn.
+
+    Saved responses are dropped too, so none of them are served escaped
+    after a 304.  The raw payloads kept alongside events aren't shown
+    anywhere, and are left as they are.
+
+    It all happens in one transaction along with the state marking it done,
+    so no fact is ever unescaped twice.
+    """
+    with _exclusive():
+        if get_state('unescaped'):
+            return
+
+        DBSession.query(CachedResponse).delete()
+        ids = [fact_id for fact_id, in DBSession.query(Fact.id).filter(
+            Fact.char_value.contains('&') | (Fact.key == 'payload'))]
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE]
+            for fact in DBSession.query(Fact).filter(Fact.id.in_(chunk)):
+                if fact.char_value is not None:
+                    fact.char_value = unescape(fact.char_value)
+                elif isinstance(fact.dict_value, dict):
+                    fact.dict_value = _unescaped(fact.dict_value)
+            DBSession.flush()
+            logging.info("Unescaped {0} facts".format(start + len(chunk)))
+        set_state('unescaped', 1)
+
+
+def _unescaped(value):
+    if isinstance(value, dict):
+        return dict((key, _unescaped(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_unescaped(item) for item in value]
+    if isinstance(value, basestring):
+        return unescape(value)
+    return value
+
+
+def entity(name):
+    """A cached `Entity.by_name`."""
+    cached = entity_cache.get(name)
+    if cached is not MISSING:
+        return cached
+
+    found = _entity_query().filter(Entity.name == name).first()
+    entity_cache.put(name, found)
+    return found
+
+
+def by_names(names):
+    """Look up many entities at once, returning them keyed by name."""
+    entities = dict()
+    missing = []
+    for name in set(names):
+        cached = entity_cache.get(name)
+        if cached is MISSING or cached is None:
+            # Something unknown might have been cached since; ask the DB.
+            missing.append(name)
+        else:
+            entities[name] = cached
+
+    for start in range(0, len(missing), CHUNK_SIZE):
+        chunk = missing[start:start + CHUNK_SIZE]
+        for found in _entity_query().filter(Entity.name.in_(chunk)):
+            entities[found.name] = found
+        for name in chunk:
+            entity_cache.put(name, entities.get(name))
+    return entities
+
+
+def forget(names):
+    """Drop entities from the cache after they have been written."""
+    for name in names:
+        entity_cache.invalidate(name)
+
+
+def _entity_query():
+    # Load facts along with their entity, and refresh any copy the session
+    # already holds since the cache decided it was too old.
+    return DBSession.query(Entity) \
+                    .options(joinedload(Entity.facts)) \
+                    .populate_existing()
+
+
+@contextmanager
+def _exclusive():
+    """Hold the DB's write lock from the start of the block until it is
+       committed at the end, so whatever the block checks first still holds
+       when its writes land.  Another process doing the same waits its turn.
+
+    The block must not commit part way through.
+    """
+    DBSession.commit()
+    if DBSession.bind.dialect.name == 'sqlite':
+        while True:
+            try:
+                DBSession.execute('BEGIN IMMEDIATE')
+                break
+            except OperationalError as e:
+                DBSession.rollback()
+                if 'locked' not in '{0}'.format(e):
+                    raise
+                logging.info("Waiting for another process to finish with "
+                             "the DB")
+    try:
+        yield
+        DBSession.commit()
+    except Exception:
+        DBSession.rollback()
+        raise
+
+
+def get_state(key, default=None):
+    row = DBSession.query(State).get(key)
+    if row is None:
+        return default
+    return row.value
+
+
+def set_state(key, value):
+    DBSession.merge(State(key=key, value=u'{0}'.format(value)))
+    DBSession.commit()
+
+
+def get_states(prefix):
+    """Every state whose key starts with `prefix`, keyed by the rest."""
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%') \
+                    .replace('_', '\\_')
+    query = DBSession.query(State) \
+                     .filter(State.key.startswith(pattern, escape='\\'))
+    return dict((row.key[len(prefix):], row.value) for row in query)
+
+
+def set_states(prefix, values):
+    """Set many states with keys starting with `prefix` at once."""
+    for key, value in values.items():
+        DBSession.merge(State(key=prefix + key, value=u'{0}'.format(value)))
+    DBSession.commit()
+
+
+def rerender_events():
+    """Rebuild render records left by an older RENDER_VERSION."""
+    stale = DBSession.query(Event) \
+                     .filter((Event.render_version != RENDER_VERSION) |
+                             (Event.render_version == None))
+    for start in range(0, stale.count(), CHUNK_SIZE):
+        rows = stale.limit(CHUNK_SIZE).all()
+        entities = by_names(row.name for row in rows)
+        known = by_names(_referenced_names(entities.values()))
+        for row in rows:
+            entity = entities.get(row.name)
+            if entity is None:
+                # An orphaned row; nothing to render it from.
+                DBSession.delete(row)
+                continue
+            _set_render(row, render_record(entity, entity['payload'], known))
+        DBSession.commit()
+        logging.info("Rendered {0} events".format(start + len(rows)))
+
+
+@metrics.timed('infoboard_query_seconds', query='recent_renders')
+def recent_renders(limit=0):
+    """The newest events as (name, type, created_at, render record) tuples.
+
+    These come straight from the events table, without touching any other
+    entity.
+    """
+    DBSession.commit()
+    query = _render_query().order_by(Event.created_at.desc())
+    if limit > 0:
+        query = query.limit(limit)
+    return _renders(query)
+
+
+@metrics.timed('infoboard_query_seconds', query='event_renders')
+def event_renders(names):
+    """Like `recent_renders`, but for the events called `names`."""
+    DBSession.commit()
+    names = list(names)
+    renders = []
+    for start in range(0, len(names), CHUNK_SIZE):
+        chunk = names[start:start + CHUNK_SIZE]
+        renders.extend(_renders(_render_query().filter(Event.name.in_(chunk))))
+    return renders
+
+
+def _render_query():
+    return DBSession.query(Event.name, Event.type, Event.created_at,
+                           Event.render, Event.render_version)
+
+
+def _renders(query):
+    renders = []
+    for name, event_type, created_at, render, version in query:
+        if version == RENDER_VERSION:
+            record = json.loads(render)
+        else:
+            # The scraper will catch up; until then, work it out here.
+            event = entity(name)
+            if event is None:
+                # Its entity has been deleted since; nothing to show.
+                logging.warning("Skipping orphaned event {0}".format(name))
+                continue
+            known = by_names(_referenced_names([event]))
+            record = render_record(event, event['payload'], known)
+        renders.append((name, event_type, created_at, record))
+    return renders
+
+
+def latest_change():
+    """The sequence number of the newest change, or 0."""
+    DBSession.commit()
+    return DBSession.query(func.max(Change.seq)).scalar() or 0
+
+
+def changes_since(seq):
+    """Names of events whose render records changed after `seq`."""
+    DBSession.commit()
+    query = DBSession.query(Change.name).filter(Change.seq > seq)
+    return set(name for name, in query)
+
+
+def expire_changes():
+    """Forget changes older than any frontend should still care about."""
+    DBSession.query(Change) \
+             .filter(Change.created_at < datetime.now() - CHANGE_LOG_AGE) \
+             .delete()
+    DBSession.commit()
+
+
+@metrics.timed('infoboard_query_seconds', query='recent_events')
 def recent_events(days=0, limit=0):
     DBSession.commit()
-    events = DBSession.query(Entity) \
-                      .filter(Entity.name.startswith('event\_', escape='\\')) \
-                      .all()
+    query = DBSession.query(Event.name).order_by(Event.created_at.desc())
     if days > 0:
         yesterday = datetime.now() - timedelta(days=days)
-        events = filter(lambda event: event['created_at'] > yesterday, events)
-    events.sort(key=lambda event: event['created_at'], reverse=True)
-    if len(events) > limit > 0:
-        events = events[:limit]
-    return events
-
-
-def top_contributions():
-    week_activity = recent_events(days=7)
-    user_activity = defaultdict(lambda: defaultdict(int))
-    repo_activity = defaultdict(lambda: defaultdict(int))
-    for event in week_activity:
+        query = query.filter(Event.created_at > yesterday)
+    if limit > 0:
+        query = query.limit(limit)
+
+    names = [name for name, in query]
+    entities = by_names(names)
+    return [entities[name] for name in names if name in entities]
+
+
+@metrics.timed('infoboard_query_seconds', query='top_contributions')
+def top_contributions(users=0, repos=0):
+    """The most active users and repositories over the last week.
+
+    Both are returned as dicts of their activity, keyed by entity name and
+    limited to the top `users` and `repos` (or everything, if 0).
+    """
+    DBSession.commit()
+    since = _hour(datetime.now() - CONTRIBUTION_WINDOW)
+
+    user_names = _top_keys('user', since, users)
+
+    # Repositories we never managed to look up don't get a spotlight, so
+    # read down the list until enough of them are found.
+    repo_names = []
+    page = repos if repos > 0 else 0
+    offset = 0
+    while True:
+        candidates = _top_keys('repo', since, page, offset)
+        for start in range(0, len(candidates), CHUNK_SIZE):
+            chunk = candidates[start:start + CHUNK_SIZE]
+            known = by_names(chunk)
+            repo_names.extend(name for name in chunk if name in known)
+        if not page or len(repo_names) >= repos or len(candidates) < page:
+            break
+        offset += page
+    if repos > 0:
+        repo_names = repo_names[:repos]
+
+    return (_activity('user', user_names, since),
+            _activity('repo', repo_names, since))
+
+
+def _top_keys(kind, since, limit=0, offset=0):
+    """The keys of `kind` with the most activity since `since`, busiest
+       first, limited to `limit` of them (or all, if 0) after `offset`.
+    """
+    total = func.sum(Contribution.count)
+    query = DBSession.query(Contribution.key) \
+                     .filter(Contribution.kind == kind) \
+                     .filter(Contribution.detail == 'count') \
+                     .filter(Contribution.hour >= since) \
+                     .group_by(Contribution.key) \
+                     .order_by(total.desc(), Contribution.key)
+    if limit > 0:
+        query = query.limit(limit).offset(offset)
+    return [key for key, in query]
+
+
+def _activity(kind, keys, since):
+    activity = dict((key, dict()) for key in keys)
+    for start in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[start:start + CHUNK_SIZE]
+        query = DBSession.query(Contribution.key, Contribution.detail,
+                                func.sum(Contribution.count)) \
+                         .filter(Contribution.kind == kind) \
+                         .filter(Contribution.key.in_(chunk)) \
+                         .filter(Contribution.hour >= since) \
+                         .group_by(Contribution.key, Contribution.detail)
+        for key, detail, count in query:
+            # Keep whole counts looking like whole numbers.
+            if count == int(count):
+                count = int(count)
+            activity[key][detail] = count
+    return activity
+
+
+def count_contribution(event, payload):
+    """Add a newly cached event to the hourly activity counts, or straight
+       to the daily ones if it is older than the window.
+    """
+    hour = _hour(event['created_at'])
+    if hour < _hour(datetime.now() - CONTRIBUTION_WINDOW):
+        for kind, key, detail, changes in _contributions(event, payload):
+            _add_rollup(hour.date(), kind, key, detail, changes)
+        return
+
+    for kind, key, detail, changes in _contributions(event, payload):
+        _add_contribution(hour, kind, key, detail, changes)
+
+
+def _contributions(event, payload):
+    """What `event` adds to each count, as (kind, key, detail, changes)."""
+    changes = 1
+    if event['type'] == 'PushEvent':
+        changes = _distinct_commits(payload)
+    elif event['type'] in SOCIAL_EVENTS:
+        changes = .1
+
+    yield 'user', event['actor'], 'count', changes
+    yield 'user', event['actor'], event['type'], changes
+
+    if event['type'] in SOCIAL_EVENTS:
         changes = 1
+    yield 'repo', event['repo'], 'count', changes
+    yield 'repo', event['repo'], event['actor'], changes
 
-        if event['type'] == 'PushEvent':
-            commits = filter(lambda x: x['distinct'],
-                             event['payload']['commits'])
-            changes = len(commits)
-        elif event['type'] in ['CommitCommentEvent', 'FollowEvent',
-                               'IssueCommentEvent', 'WatchEvent',
-                               'PullRequestReviewCommentEvent',]:
-            # Social (non-coding) events carry less weight
-            changes = .1
-
-        user_activity[event['actor']]['count'] += changes
-        user_activity[event['actor']][event['type']] += changes
-
-        if Entity.by_name(event['repo']):
-            if event['type'] in ['CommitCommentEvent', 'FollowEvent',
-                               'IssueCommentEvent', 'WatchEvent',
-                               'PullRequestReviewCommentEvent',]:
-                changes = 1
-            repo_activity[event['repo']]['count'] += changes
-            repo_activity[event['repo']][event['actor']] += changes
-    return user_activity, repo_activity
 
+def _add_contribution(hour, kind, key, detail, changes):
+    row = DBSession.query(Contribution).get((hour, kind, key, detail))
+    if not row:
+        row = Contribution(hour=hour, kind=kind, key=key, detail=detail,
+                           count=0)
+        DBSession.add(row)
+    row.count += changes
 
-def event_info(event):
-    event_name = u'event_{0}'.format(event['id'])
-    if not Entity.by_name(event_name):
+
+def expire_contributions():
+    """Roll the buckets that have left the window up into daily totals."""
+    since = _hour(datetime.now() - CONTRIBUTION_WINDOW)
+    expired = DBSession.query(Contribution).filter(Contribution.hour < since)
+    totals = dict()
+    for row in expired:
+        bucket = (row.hour.date(), row.kind, row.key, row.detail)
+        totals[bucket] = totals.get(bucket, 0) + row.count
+    for (day, kind, key, detail), changes in totals.items():
+        _add_rollup(day, kind, key, detail, changes)
+    expired.delete()
+    DBSession.commit()
+
+
+def backfill_rollups():
+    """Count the events older than the window into the daily totals, for
+       DBs from before every expired hour was rolled up.
+
+    Events `compact` deleted back then were rolled up as they went, so
+    only the ones still cached are counted.  Like `unescape_facts`, it all
+    happens in one transaction along with the state marking it done.
+    """
+    with _exclusive():
+        if get_state('rolled_up'):
+            return
+
+        since = _hour(datetime.now() - CONTRIBUTION_WINDOW)
+        DBSession.query(Contribution).filter(Contribution.hour < since) \
+                 .delete()
+        names = [name for name, in DBSession.query(Event.name)
+                                            .filter(Event.created_at < since)]
+        for start in range(0, len(names), CHUNK_SIZE):
+            chunk = names[start:start + CHUNK_SIZE]
+            for event in _entity_query().filter(Entity.name.in_(chunk)):
+                count_contribution(event, event['payload'])
+            DBSession.flush()
+            forget(chunk)
+            logging.info("Rolled up {0} events".format(start + len(chunk)))
+        set_state('rolled_up', 1)
+
+
+def daily_contributions(kind, keys, days):
+    """The activity of each of `keys` over the last `days` days, as dicts
+       of totals keyed by date.
+
+    Days that have left the hourly window are read from their rollups.
+    """
+    keys = list(keys)
+    history = dict((key, dict()) for key in keys)
+    start = datetime.now().date() - timedelta(days=days - 1)
+    DBSession.commit()
+    for offset in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[offset:offset + CHUNK_SIZE]
+        rollups = DBSession.query(Rollup.key, Rollup.day, Rollup.count) \
+                           .filter(Rollup.kind == kind) \
+                           .filter(Rollup.key.in_(chunk)) \
+                           .filter(Rollup.detail == 'count') \
+                           .filter(Rollup.day >= start)
+        hours = DBSession.query(Contribution.key, Contribution.hour,
+                                Contribution.count) \
+                         .filter(Contribution.kind == kind) \
+                         .filter(Contribution.key.in_(chunk)) \
+                         .filter(Contribution.detail == 'count')
+        for key, when, count in chain(rollups, hours):
+            if isinstance(when, datetime):
+                when = when.date()
+            if when >= start:
+                history[key][when] = history[key].get(when, 0) + count
+    return history
+
+
+def rebuild_contributions():
+    """Count the last week from the cached events, unless something already
+       has, e.g. for DBs from before the hourly counts were kept.
+    """
+    with _exclusive():
+        if DBSession.query(Contribution).first():
+            return
+        # From the same hour `backfill_rollups` stops at.
+        since = _hour(datetime.now() - CONTRIBUTION_WINDOW)
+        names = [name for name, in DBSession.query(Event.name)
+                                            .filter(Event.created_at >= since)]
+        for start in range(0, len(names), CHUNK_SIZE):
+            chunk = names[start:start + CHUNK_SIZE]
+            for event in _entity_query().filter(Entity.name.in_(chunk)):
+                count_contribution(event, event['payload'])
+            DBSession.flush()
+            forget(chunk)
+
+
+def _hour(when):
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+@metrics.timed('infoboard_compact_seconds')
+def compact(retention):
+    """Delete events older than `retention`, along with any comments and
+       issues nothing refers to any more.  Their activity has already been
+       rolled up into daily totals as it left the hourly window.
+
+    Returns how many events were deleted.
+    """
+    if retention < CONTRIBUTION_WINDOW:
+        logging.warning("Keeping events for {0} days, the length of the "
+                        "contribution window".format(CONTRIBUTION_WINDOW.days))
+        retention = CONTRIBUTION_WINDOW
+    old = DBSession.query(Event.name) \
+                   .filter(Event.created_at < datetime.now() - retention)
+
+    deleted = 0
+    while True:
+        names = [name for name, in old.limit(CHUNK_SIZE)]
+        if not names:
+            break
+        ids = DBSession.query(Entity.id).filter(Entity.name.in_(names))
+        _delete_entities(entity_id for entity_id, in ids)
+        DBSession.query(Event).filter(Event.name.in_(names)) \
+                 .delete(synchronize_session=False)
+        DBSession.query(Change).filter(Change.name.in_(names)) \
+                 .delete(synchronize_session=False)
+        DBSession.query(Payload).filter(Payload.name.in_(names)) \
+                 .delete(synchronize_session=False)
+        DBSession.commit()
+        forget(names)
+        deleted += len(names)
+        logging.info("Compacted {0} events".format(deleted))
+
+    delete_orphans()
+    return deleted
+
+
+def _add_rollup(day, kind, key, detail, changes):
+    row = DBSession.query(Rollup).get((day, kind, key, detail))
+    if not row:
+        row = Rollup(day=day, kind=kind, key=key, detail=detail, count=0)
+        DBSession.add(row)
+    row.count += changes
+
+
+def delete_orphans():
+    """Delete comments and issues that no cached event refers to."""
+    referenced = DBSession.query(Fact.char_value) \
+                          .filter(Fact.key.in_(['comment', 'issue'])) \
+                          .filter(Fact.char_value != None)
+    comments = Entity.name.startswith('comment\_', escape='\\')
+    issues = Entity.name.startswith('issue\_', escape='\\')
+    orphans = DBSession.query(Entity.id, Entity.name) \
+                       .filter(comments | issues) \
+                       .filter(~Entity.name.in_(referenced)) \
+                       .all()
+    _delete_entities(entity_id for entity_id, _ in orphans)
+    DBSession.commit()
+    forget(name for _, name in orphans)
+    if orphans:
+        logging.info("Deleted {0} orphaned comments and issues"
+                     .format(len(orphans)))
+    return len(orphans)
+
+
+def _delete_entities(ids):
+    # Knowledge doesn't cascade deletes to facts, so both go by hand.
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        DBSession.query(Fact).filter(Fact.id.in_(chunk)) \
+                 .delete(synchronize_session=False)
+        DBSession.query(Entity).filter(Entity.id.in_(chunk)) \
+                 .delete(synchronize_session=False)
+
+
+def optimize(engine, vacuum=False):
+    """Refresh the query planner's statistics, and optionally give the
+       space freed by `compact` back to the filesystem.
+    """
+    DBSession.commit()
+    engine.execute('ANALYZE')
+    if vacuum and engine.dialect.name == 'sqlite':
+        engine.execute('VACUUM')
+
+
+@metrics.timed('infoboard_ingest_seconds', kind='events')
+def ingest_events(events):
+    """Cache a page of raw events from Github in a single transaction.
+
+    Everything the page refers to is looked up with one query per kind of
+    entity, and events that are already cached are left alone, so ingesting
+    the same page twice is harmless.  Returns the event entities in order.
+    """
+    events = list(events)
+    known = by_names(_event_name(event) for event in events)
+    new_events = []
+    for event in events:
+        event_name = _event_name(event)
+        if event_name not in known:
+            # Placeholder so a page repeating an event caches it once.
+            known[event_name] = None
+            new_events.append(event)
+
+    comments = [event['payload']['comment'] for event in new_events
+                if 'Comment' in event['type']]
+    issues = [event['payload']['issue'] for event in new_events
+              if 'Issue' in event['type']]
+    known.update(by_names(_user_name(event['actor'])
+                          for event in new_events))
+    known.update(by_names(_comment_name(comment) for comment in comments))
+    known.update(by_names(_issue_name(issue) for issue in issues))
+    known.update(by_names(event['repo']['name'] for event in new_events))
+
+    for event in new_events:
+        event_name = _event_name(event)
         logging.info("Caching new event {0}".format(event_name))
         entity = Entity(event_name)
         entity['name'] = event_name
-        entity[u'actor'] = user_info(event['actor']).name
-        try:
-            entity[u'repo'] = repo_info(event['repo']['name']).name
-        except:
-            entity['repo'] = event['repo']['name']
+        entity[u'actor'] = _update_user(event['actor'], known, set()).name
+        entity['repo'] = event['repo']['name']
         entity[u'type'] = event['type']
-        entity[u'payload'] = event['payload']
+        entity[u'payload'] = compact_payload(event['payload'])
+        DBSession.add(Payload(name=event_name, data=_pack(event['payload'])))
         entity[u'created_at'] = datetime.strptime(event['created_at'], '%Y-%m-%dT%H:%M:%SZ')
         if 'Comment' in event['type']:
-            entity[u'comment'] = comment_info(event['payload']['comment']).name
+            entity[u'comment'] = _add_comment(event['payload']['comment'],
+                                              known).name
         if 'Issue' in event['type']:
-            entity['issue'] = issue_info(event['payload']['issue']).name
+            entity['issue'] = _add_issue(event['payload']['issue'],
+                                         known).name
         DBSession.add(entity)
+        row = _event_row(entity)
+        _set_render(row, render_record(entity, event['payload'], known))
+        DBSession.add(row)
+        count_contribution(entity, event['payload'])
+        known[event_name] = entity
+    DBSession.commit()
+    forget(known)
+    metrics.count('infoboard_ingested_total', len(new_events), kind='events')
+
+    return [known[_event_name(event)] for event in events]
+
+
+def event_info(event):
+    return ingest_events([event])[0]
+
+
+def _event_row(entity):
+    return Event(name=entity.name,
+                 created_at=entity['created_at'],
+                 type=entity['type'],
+                 actor=entity['actor'],
+                 repo=entity['repo'])
+
+
+def compact_payload(payload):
+    """The parts of an event's payload that infoboard uses, kept in the same
+       shape so either can be rendered or counted.
+
+    Push events only keep the message of each distinct commit, along with
+    how many there were.
+    """
+    compact = dict((key, payload[key]) for key in
+                   ['action', 'number', 'ref', 'ref_type'] if key in payload)
+    if 'commits' in payload:
+        compact['commits'] = [dict(message=commit['message'], distinct=True)
+                              for commit in payload['commits']
+                              if commit['distinct']]
+        compact['distinct_commits'] = len(compact['commits'])
+    for key in ['target', 'member']:
+        if key in payload:
+            compact[key] = dict((field, payload[key][field])
+                                for field in ['login', 'name']
+                                if field in payload[key])
+    if 'forkee' in payload:
+        compact['forkee'] = dict(full_name=_forkee_name(payload['forkee']))
+    if 'pages' in payload:
+        compact['pages'] = [dict(title=page['title'])
+                            for page in payload['pages']]
+    return compact
+
+
+def full_payload(name):
+    """The payload of the event called `name` as Github sent it, if known."""
+    row = DBSession.query(Payload).get(name)
+    if row is None:
+        return None
+    return _unpack(row.data)
+
+
+def _pack(payload):
+    return zlib.compress(json.dumps(payload).encode('utf-8'))
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def _distinct_commits(payload):
+    if 'distinct_commits' in payload:
+        return payload['distinct_commits']
+    return len(filter(lambda x: x['distinct'], payload['commits']))
+
+
+def _forkee_name(forkee):
+    return forkee.get('full_name') or '{0}/{1}'.format(
+        forkee['owner']['login'], forkee['name'])
+
+
+def render_record(event, payload, known):
+    """Everything needed to draw `event`, worked out once when it is cached.
+
+    `known` must hold the entities the event refers to (its actor, repo,
+    comment and issue), keyed by name.
+    """
+    actor = known.get(event['actor'])
+    repo = known.get(event['repo'])
+    record = dict(type=event['type'])
+    record['actor'] = dict(name=actor['name'] if actor else event['actor'],
+                           avatar=actor['avatar'] if actor else None)
+    record['repo'] = dict(name=event['repo'])
+    if repo:
+        record['repo'].update(_repo_render(repo))
+    if 'issue' in event and known.get(event['issue']):
+        issue = known[event['issue']]
+        record['issue'] = dict(number=issue['number'], title=issue['title'])
+    if 'comment' in event and known.get(event['comment']):
+        body = known[event['comment']]['body']
+        if len(body) > COMMENT_EXCERPT:
+            body = body[:COMMENT_EXCERPT - 1] + '\u2026'
+        record['comment'] = body
+    if event['type'] == 'PushEvent':
+        record['commits'] = [commit['message'] for commit in payload['commits']
+                             if commit['distinct']]
+
+    # Only the few parts of the payload the board shows.
+    details = dict((key, payload[key]) for key in
+                   ['action', 'number', 'ref', 'ref_type'] if key in payload)
+    if 'target' in payload:
+        details['target'] = payload['target'].get('name') or \
+                            payload['target']['login']
+    if 'member' in payload:
+        details['member'] = payload['member'].get('name') or \
+                            payload['member']['login']
+    if 'forkee' in payload:
+        details['forkee'] = _forkee_name(payload['forkee'])
+    if 'pages' in payload:
+        details['pages'] = [page['title'] for page in payload['pages']]
+    record['payload'] = details
+    return record
+
+
+def _repo_render(repo):
+    return dict(url=repo['url'], description=repo['description'])
+
+
+def _set_render(row, record):
+    row.render = json.dumps(record)
+    row.render_version = RENDER_VERSION
+    # Let the frontends know.
+    DBSession.add(Change(name=row.name))
+
+
+def _referenced_names(events):
+    names = set()
+    for event in events:
+        names.update(event[key]
+                     for key in ['actor', 'repo', 'comment', 'issue']
+                     if key in event)
+    return names
+
+
+def _rerender_repos(repos):
+    """Fill in repository details on events cached before their repo was."""
+    repos = dict((repo.name, repo) for repo in repos)
+    if not repos:
+        return
+    rows = DBSession.query(Event).filter(Event.repo.in_(list(repos)))
+    for row in rows:
+        if row.render_version != RENDER_VERSION:
+            continue
+        record = json.loads(row.render)
+        record['repo'].update(_repo_render(repos[row.repo]))
+        _set_render(row, record)
+
+
+@metrics.timed('infoboard_ingest_seconds', kind='users')
+def ingest_users(users):
+    """Cache (or update) a list of users in a single transaction.
+
+    Only users whose details changed are written, so a member list that
+    looks the same as last time costs no more than the query.
+    """
+    users = list(users)
+    known = by_names(_user_name(user) for user in users)
+    changed = set()
+    entities = [_update_user(user, known, changed) for user in users]
+    if changed:
         DBSession.commit()
-    return Entity.by_name(event_name)
+        forget(changed)
+    metrics.count('infoboard_ingested_total', len(changed), kind='users')
+    return entities
 
 
 def user_info(user):
-    user_name = u'user_{0}'.format(user['id'])
-    if not Entity.by_name(user_name):
+    return ingest_users([user])[0]
+
+
+def _update_user(user, known, changed):
+    """Cache `user`, adding its name to `changed` if anything was written."""
+    user_name = _user_name(user)
+    entity = known.get(user_name)
+    if not entity:
         logging.info("Caching new user {0}".format(user_name))
-        entity = Entity(user_name)
+        entity = known[user_name] = Entity(user_name)
         DBSession.add(entity)
 
-    entity = Entity.by_name(user_name)
-    entity['login'] = user['login']
-    entity['avatar'] = user['avatar_url']
-    # Not everyone has set a name for their account.
+    facts = {'login': user['login'], 'avatar': user['avatar_url']}
+    # Not everyone has set a name for their account, and member lists and
+    # events leave it out, so don't let those overwrite a real one.
     if user.get('name'):
-        entity[u'name'] = user['name']
-    else:
-        entity[u'name'] = user['login']
-    DBSession.commit()
+        facts['name'] = user['name']
+    elif not entity.get('name'):
+        facts['name'] = user['login']
+    if _set_facts(entity, facts):
+        changed.add(user_name)
 
     return entity
 
 
+@metrics.timed('infoboard_ingest_seconds', kind='repos')
+def ingest_repos(repos):
+    """Cache (or update) a list of repositories in a single transaction.
+
+    Repositories that could not be fetched may be passed as None, and are
+    returned as None.  When each was fetched is kept in the state table,
+    for `stale_repos`, so repositories that haven't changed aren't written
+    at all, and events are only rendered again for those that have.
+    """
+    repos = list(repos)
+    found = filter(None, repos)
+    known = by_names(_repo_name(repo) for repo in found)
+    known.update(by_names(_user_name(repo['owner']) for repo in found))
+    changed = set()
+    entities = [_update_repo(repo, known, changed) if repo else None
+                for repo in repos]
+    _rerender_repos(known[_repo_name(repo)] for repo in found
+                    if _repo_name(repo) in changed)
+    if changed:
+        DBSession.commit()
+        forget(changed)
+    now = datetime.now().strftime(FETCHED_FORMAT)
+    set_states('fetched:', dict((_repo_name(repo), now) for repo in found))
+    metrics.count('infoboard_ingested_total', len(changed), kind='repos')
+    return entities
+
+
 def repo_info(repo):
-    if not repo:
-        return
+    return ingest_repos([repo])[0]
 
-    repo_name = repo.get('full_name', '{0}/{1}'.format(repo['owner']['login'],
-                                                       repo['name']))
-    if not Entity.by_name(repo_name):
+
+def _update_repo(repo, known, changed):
+    """Cache `repo` and its owner, adding the names of whichever changed
+       to `changed`.
+    """
+    repo_name = _repo_name(repo)
+    entity = known.get(repo_name)
+    if not entity:
         logging.info("Caching new repository {0}".format(repo_name))
-        entity = Entity(repo_name)
+        entity = known[repo_name] = Entity(repo_name)
         DBSession.add(entity)
 
-    entity = Entity.by_name(repo_name)
-    entity['name'] = repo['full_name']
+    owner = _update_user(repo['owner'], known, changed)
     # Evidently you cannot set facts to None. (?)
-    if not repo['description']:
-        entity['description'] = u''
-    else:
-        entity['description'] = repo['description']
-    entity['url'] = repo['html_url']
-    entity['owner'] = user_info(repo['owner']).name
-    DBSession.commit()
+    facts = {'name': repo['full_name'],
+             'description': repo['description'] or u'',
+             'url': repo['html_url'],
+             'owner': owner.name}
+    if _set_facts(entity, facts):
+        changed.add(repo_name)
 
     return entity
 
 
+def stale_repos(ttl, limit=0):
+    """The repositories active this week whose details were last fetched
+       more than `ttl` ago (or never), least recently fetched first.
+    """
+    DBSession.commit()
+    since = _hour(datetime.now() - CONTRIBUTION_WINDOW)
+    names = [key for key, in DBSession.query(Contribution.key)
+                                      .filter(Contribution.kind == 'repo')
+                                      .filter(Contribution.detail == 'count')
+                                      .filter(Contribution.hour >= since)
+                                      .distinct()]
+    cutoff = (datetime.now() - ttl).strftime(FETCHED_FORMAT)
+    fetched = get_states('fetched:')
+    stale = sorted((fetched.get(name, ''), name) for name in by_names(names))
+    stale = [item for item in stale if item[0] < cutoff]
+    if limit > 0:
+        stale = stale[:limit]
+    return [name for fetched_at, name in stale]
+
+
+def _set_facts(entity, facts):
+    """Set whichever of `facts` differ from what `entity` already has,
+       returning whether any did.
+    """
+    changed = False
+    for key, value in facts.items():
+        if entity.get(key) != value:
+            entity[key] = value
+            changed = True
+    return changed
+
+
+@metrics.timed('infoboard_ingest_seconds', kind='comments')
 def comment_info(comment):
-    comment_name = u'comment_{0}'.format(comment['id'])
-    if not Entity.by_name(comment_name):
+    known = by_names([_comment_name(comment)])
+    entity = _add_comment(comment, known)
+    DBSession.commit()
+    forget(known)
+    return entity
+
+
+def _add_comment(comment, known):
+    comment_name = _comment_name(comment)
+    if comment_name not in known:
         logging.info("Caching new comment {0}".format(comment_name))
-        entity = Entity(comment_name)
+        entity = known[comment_name] = Entity(comment_name)
         entity[u'body'] = comment['body']
         DBSession.add(entity)
-        DBSession.commit()
-    return Entity.by_name(comment_name)
+    return known[comment_name]
 
 
+@metrics.timed('infoboard_ingest_seconds', kind='issues')
 def issue_info(issue):
-    issue_name = u'issue_{0}'.format(issue['id'])
-    if not Entity.by_name(issue_name):
+    known = by_names([_issue_name(issue)])
+    entity = _add_issue(issue, known)
+    DBSession.commit()
+    forget(known)
+    return entity
+
+
+def _add_issue(issue, known):
+    issue_name = _issue_name(issue)
+    if issue_name not in known:
         logging.info("Caching new issue {0}".format(issue_name))
-        entity = Entity(issue_name)
+        entity = known[issue_name] = Entity(issue_name)
         entity[u'title'] = issue['title']
         entity[u'number'] = issue['number']
         DBSession.add(entity)
-        DBSession.commit()
-    return Entity.by_name(issue_name)
+    return known[issue_name]
+
+
+def _event_name(event):
+    return u'event_{0}'.format(event['id'])
+
+
+def _user_name(user):
+    return u'user_{0}'.format(user['id'])
+
+
+def _repo_name(repo):
+    return repo.get('full_name', '{0}/{1}'.format(repo['owner']['login'],
+                                                  repo['name']))
+
+
+def _comment_name(comment):
+    return u'comment_{0}'.format(comment['id'])
+
+
+def _issue_name(issue):
+    return u'issue_{0}'.format(issue['id'])
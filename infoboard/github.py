@@ -1,38 +1,162 @@
 """Provides a wrapper around certain github API calls."""
 from __future__ import unicode_literals
 
-from cgi import escape
+from multiprocessing.pool import ThreadPool
 from urllib2 import HTTPError
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import json
 import logging
+import threading
+import time
 
+try:
+    # Several times faster at decoding, when installed.
+    import ujson as json_backend
+except ImportError:
+    json_backend = json
+
+from httpcache import NegativeCache
 import data
+import metrics
+
+
+def make_session(pool_size=10, retries=3, backoff=0.5):
+    """A keep-alive session that reuses up to `pool_size` connections per
+       host and retries failed connections with exponential backoff.
+    """
+    retry = Retry(total=retries, connect=retries, read=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=[502, 503, 504],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def decode(content):
+    """Parse a response body as Github sent it.
+
+    Nothing is escaped here; text is escaped for markup only when the board
+    is drawn (see viewmodel).
+    """
+    return json_backend.loads(content)
+
+
+class RateLimiter(object):
+    """A token bucket shared by every thread talking to Github.
+
+    The bucket is refilled from the x-ratelimit-* headers of each response, so
+    callers block in `acquire` once the hourly budget is spent and wake up
+    when Github resets it.
+    """
+    def __init__(self, limit=5000):
+        self.condition = threading.Condition()
+        self.remaining = limit
+        self.reset = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.remaining <= 0:
+                wait = self.reset - time.time()
+                if wait <= 0:
+                    # The window should have rolled over; let one through to
+                    # find out what the new budget is.
+                    self.remaining = 1
+                    break
+                logging.warning("Rate limit spent, waiting {0:.0f}s."
+                                .format(wait))
+                self.condition.wait(wait)
+            self.remaining -= 1
+
+    def release(self):
+        """Give back the call taken by `acquire` for a request Github didn't
+           charge for (a 304, or one that never reached it).
+        """
+        with self.condition:
+            self.remaining += 1
+            self.condition.notify_all()
+
+    def update(self, remaining, reset):
+        with self.condition:
+            if reset != self.reset:
+                # A new window; trust Github's count.
+                self.remaining = remaining
+            else:
+                # Responses arrive out of order, so keep the lower count.
+                self.remaining = min(self.remaining, remaining)
+            self.reset = reset
+            self.condition.notify_all()
 
 
 class Github(object):
-    def __init__(self, auth=None):
+    def __init__(self, auth=None, cache=None, session=None, timeout=30,
+                 missing=None):
         self.auth = auth
+        self.cache = cache
+        self.session = session or make_session()
+        self.session.auth = auth
+        self.timeout = timeout
+        self.limiter = RateLimiter()
         self.rate_limiting = (5000, 5000)
-        self.broken_repos = ['/']
+        # The least number of seconds Github wants between polls of a feed.
+        self.poll_interval = 0
+        # What Github couldn't find, so it isn't asked for again soon.
+        self.missing = missing or NegativeCache(load=False)
 
     def _requests_wrapper(self, url):
+        headers = dict()
+        if self.cache:
+            headers = self.cache.conditional_headers(url)
+
+        self.limiter.acquire()
+        start = time.time()
         try:
-            if self.auth:
-                r = requests.get(url, auth=self.auth)
-            else:
-                r = requests.get(url)
-        except requests.exceptions.ConnectionError:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            logging.error("Could not reach {0}: {1}".format(url, e))
+            self.limiter.release()
+            metrics.count('infoboard_github_requests_total', status='error')
+            if self.cache:
+                # Better to show what we had than nothing at all.
+                return self.cache.stale(url) or []
             return []
 
+        metrics.observe('infoboard_github_request_seconds',
+                        time.time() - start)
+        metrics.count('infoboard_github_requests_total', status=r.status_code)
+        metrics.count('infoboard_github_response_bytes_total', len(r.content))
+
         self.rate_limiting = (r.headers['x-ratelimit-remaining'],
                               r.headers['x-ratelimit-limit'])
+        metrics.gauge('infoboard_github_ratelimit_remaining',
+                      int(r.headers['x-ratelimit-remaining']))
+        if 'x-ratelimit-reset' in r.headers:
+            self.limiter.update(int(r.headers['x-ratelimit-remaining']),
+                                int(r.headers['x-ratelimit-reset']))
+            metrics.gauge('infoboard_github_ratelimit_reset',
+                          int(r.headers['x-ratelimit-reset']))
+        if 'x-poll-interval' in r.headers:
+            self.poll_interval = int(r.headers['x-poll-interval'])
+        if r.status_code == 304:
+            # Unchanged since last time, and free as far as the limit goes.
+            self.limiter.release()
+            return self.cache.hit(url)
         if r.status_code == 404:
+            if self.cache:
+                self.cache.forget(url)
             r.raise_for_status()
-        
+
         try:
-            payload = json.loads(escape(r.content))
+            payload = decode(r.content)
         except ValueError:
             # JSON decoding failed
             return dict()
@@ -41,27 +165,105 @@ class Github(object):
             logging.error(payload)
             return dict()
 
+        if self.cache:
+            self.cache.store(url, r.headers, payload)
         return payload
 
-    def organization_members(self, org_name):
-        members = self._requests_wrapper('https://api.github.com/orgs/%s/members' % org_name)
-        return map(data.user_info, members)
+    # The fetch_* methods only talk to Github and are safe to call from
+    # worker threads.  The others also cache what they find, which must
+    # happen on one thread at a time.
 
-    def user_activity(self, user_name):
-        events = self._requests_wrapper('https://api.github.com/users/%s/events' % user_name)
-        return map(data.event_info, events)
+    def fetch_members(self, org_name):
+        return self._requests_wrapper(
+            'https://api.github.com/orgs/%s/members' % org_name)
 
-    def repo_information(self, repo_name):
-        if repo_name in self.broken_repos:
+    def fetch_events(self, user_name):
+        return self._requests_wrapper(
+            'https://api.github.com/users/%s/events' % user_name)
+
+    def fetch_org_events(self, org_name, since=0, pages=3):
+        """Recent events across a whole organization, newest first.
+
+        Reading stops at the first event with an id of `since` or lower, so
+        a quiet organization costs a single (usually 304) request.  When
+        authenticated, the user's view of the organization is read as well,
+        which includes activity in private repositories.
+        """
+        urls = ['https://api.github.com/orgs/%s/events' % org_name]
+        if self.auth:
+            urls.append('https://api.github.com/users/%s/events/orgs/%s'
+                        % (self.auth[0], org_name))
+
+        events = dict()
+        for url in urls:
+            for page in range(1, pages + 1):
+                batch = self._requests_wrapper('%s?per_page=100&page=%d'
+                                               % (url, page))
+                fresh = [event for event in batch
+                         if int(event['id']) > since]
+                for event in fresh:
+                    events[event['id']] = event
+                if len(fresh) < len(batch) or len(batch) < 100:
+                    break
+        return sorted(events.values(), key=lambda event: int(event['id']),
+                      reverse=True)
+
+    def fetch_repo(self, repo_name):
+        key = 'repo:{0}'.format(repo_name)
+        # Events in deleted repositories name them '/'.
+        if repo_name == '/' or self.missing.missing(key):
             return
         try:
-            repository = self._requests_wrapper('https://api.github.com/repos/%s' % repo_name)
-            return data.repo_info(repository)
+            repo = self._requests_wrapper(
+                'https://api.github.com/repos/%s' % repo_name)
         except requests.exceptions.HTTPError:
             logging.error("Error finding repo http://github.com/{0}"
                           .format(repo_name))
-            self.broken_repos.append(repo_name)
+            self.missing.add(key)
             return None
+        self.missing.remove(key)
+        return repo
+
+    def fetch_feeds(self, logins, workers=1):
+        """The feeds of `logins` as (login, events) pairs, as `workers`
+           threads finish reading them.
+        """
+        def fetch(login):
+            key = 'user:{0}'.format(login)
+            if self.missing.missing(key):
+                return login, []
+            logging.debug("Looking up user {}".format(login))
+            try:
+                events = self.fetch_events(login)
+            except requests.exceptions.HTTPError:
+                logging.error("Error getting events for {0}".format(login))
+                self.missing.add(key)
+                return login, []
+            self.missing.remove(key)
+            return login, events
+        return self._map(fetch, logins, workers)
+
+    def fetch_repos(self, repo_names, workers=1):
+        """Like `fetch_repo`, for each of `repo_names`, in no order."""
+        return self._map(self.fetch_repo, repo_names, workers)
+
+    def _map(self, function, items, workers):
+        pool = ThreadPool(workers)
+        try:
+            for result in pool.imap_unordered(function, items):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def organization_members(self, org_name):
+        return data.ingest_users(self.fetch_members(org_name))
+
+    def user_activity(self, user_name):
+        return data.ingest_events(self.fetch_events(user_name))
+
+    def repo_information(self, repo_name):
+        return data.repo_info(self.fetch_repo(repo_name))
 
 
 if __name__ == "__main__":
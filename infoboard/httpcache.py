@@ -0,0 +1,223 @@
+"""
+Remembers the ETag/Last-Modified validators Github sends so that repeated
+requests can be made conditional.  A 304 costs nothing against the rate
+limit, and the payload is served from here instead.
+
+Also remembers what Github couldn't find at all, so it isn't asked again
+every time it's mentioned.
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import json
+import threading
+
+from knowledge.model import DBSession
+
+from schema import CachedResponse, Missing
+
+
+class ValidatorCache(object):
+    def __init__(self, load=True):
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+
+        # Processes that don't own the DB start empty, and never `save`;
+        # see `changes` and `merge`.
+        if not load:
+            return
+
+        # Everything is loaded up front so lookups never touch the DB.
+        for row in DBSession.query(CachedResponse):
+            self.entries[row.url] = (row.etag, row.last_modified,
+                                     json.loads(row.payload))
+        DBSession.commit()
+
+    def conditional_headers(self, url):
+        """Headers that make a request for `url` conditional, if possible."""
+        with self.lock:
+            entry = self.entries.get(url)
+        if not entry:
+            return dict()
+
+        etag, last_modified, _ = entry
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def hit(self, url):
+        """The payload stored for `url`, after Github answered 304."""
+        with self.lock:
+            self.hits += 1
+            return self.entries[url][2]
+
+    def stale(self, url):
+        """The payload stored for `url`, if any, when Github is unreachable."""
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry:
+            return entry[2]
+
+    def store(self, url, headers, payload):
+        """Remember a fresh 200 response for `url`."""
+        etag = headers.get('etag')
+        last_modified = headers.get('last-modified')
+        with self.lock:
+            self.misses += 1
+            if not (etag or last_modified):
+                return
+            self.entries[url] = (etag, last_modified, payload)
+            self.dirty.add(url)
+
+    def forget(self, url):
+        with self.lock:
+            if self.entries.pop(url, None):
+                self.dirty.add(url)
+
+    def changes(self):
+        """What changed since the last call, for another process's cache to
+           `merge`: the changed entries keyed by URL (None for those that
+           were dropped), then how many hits and misses there were.
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+            return (dict((url, self.entries.get(url)) for url in dirty),
+                    hits, misses)
+
+    def merge(self, entries, hits=0, misses=0, save=True):
+        """Take on `entries` from another process's cache, written to the DB
+           by the next `save` unless `save` is False.
+        """
+        with self.lock:
+            for url, entry in entries.items():
+                if entry is None:
+                    self.entries.pop(url, None)
+                else:
+                    self.entries[url] = entry
+                if save:
+                    self.dirty.add(url)
+            self.hits += hits
+            self.misses += misses
+
+    def save(self):
+        """Write changed entries to the DB so they survive restarts."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            changes = [(url, self.entries.get(url)) for url in dirty]
+
+        for url, entry in changes:
+            if entry is None:
+                DBSession.query(CachedResponse) \
+                         .filter(CachedResponse.url == url) \
+                         .delete()
+                continue
+            etag, last_modified, payload = entry
+            DBSession.merge(CachedResponse(url=url,
+                                           etag=etag,
+                                           last_modified=last_modified,
+                                           payload=json.dumps(payload),
+                                           fetched_at=datetime.now()))
+        DBSession.commit()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            ratio = float(self.hits) / total if total else 0.0
+            return dict(hits=self.hits, misses=self.misses,
+                        ratio=ratio, entries=len(self.entries))
+
+
+class NegativeCache(object):
+    """Repositories and users that turned up missing, keyed like
+       'repo:owner/name' or 'user:login'.
+
+    Each is left alone for `retry` before it is asked for again, twice as
+    long after every further miss, up to `max_retry`.
+    """
+    def __init__(self, load=True, retry=timedelta(hours=1),
+                 max_retry=timedelta(days=7)):
+        self.lock = threading.Lock()
+        self.retry = retry
+        self.max_retry = max_retry
+        # key -> (failures, retry_at)
+        self.entries = dict()
+        self.dirty = set()
+        self.skipped = 0
+
+        if not load:
+            return
+        for row in DBSession.query(Missing):
+            self.entries[row.key] = (row.failures, row.retry_at)
+        DBSession.commit()
+
+    def missing(self, key, now=None):
+        """Whether `key` was missing, too recently to ask again."""
+        now = now or datetime.now()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                self.skipped += 1
+                return True
+            return False
+
+    def add(self, key, now=None):
+        now = now or datetime.now()
+        with self.lock:
+            failures = self.entries.get(key, (0, None))[0] + 1
+            wait = min(self.retry * 2 ** (failures - 1), self.max_retry)
+            self.entries[key] = (failures, now + wait)
+            self.dirty.add(key)
+
+    def remove(self, key):
+        """`key` was found after all."""
+        with self.lock:
+            if self.entries.pop(key, None):
+                self.dirty.add(key)
+
+    def changes(self):
+        """Like `ValidatorCache.changes`: the changed entries keyed by key,
+           then how many requests were skipped.
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            skipped, self.skipped = self.skipped, 0
+            return (dict((key, self.entries.get(key)) for key in dirty),
+                    skipped)
+
+    def merge(self, entries, skipped=0, save=True):
+        """Like `ValidatorCache.merge`."""
+        with self.lock:
+            for key, entry in entries.items():
+                if entry is None:
+                    self.entries.pop(key, None)
+                else:
+                    self.entries[key] = entry
+                if save:
+                    self.dirty.add(key)
+            self.skipped += skipped
+
+    def save(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            changes = [(key, self.entries.get(key)) for key in dirty]
+
+        for key, entry in changes:
+            if entry is None:
+                DBSession.query(Missing).filter(Missing.key == key).delete()
+                continue
+            failures, retry_at = entry
+            DBSession.merge(Missing(key=key, failures=failures,
+                                    retry_at=retry_at))
+        DBSession.commit()
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries), skipped=self.skipped)
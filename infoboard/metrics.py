@@ -0,0 +1,148 @@
+"""
+Counters and timers for the scraper and the frontends, exported in
+Prometheus' text format, either as a file for node_exporter's textfile
+collector or from `web`'s /metrics.
+"""
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import cProfile
+from functools import wraps
+import os
+import threading
+import time
+
+lock = threading.Lock()
+# Current values, keyed by (name, labels) with labels a sorted tuple of
+# (label, value) pairs.
+values = dict()
+# The Prometheus type of each metric.
+types = dict()
+
+# The series each summary is made of.
+SUMMARY_SUFFIXES = ['_count', '_sum']
+
+
+def count(name, value=1, **labels):
+    """Add `value` to the counter `name`."""
+    key = _key(name, labels)
+    with lock:
+        values[key] = values.get(key, 0) + value
+        types.setdefault(name, 'counter')
+
+
+def gauge(name, value, **labels):
+    """Set the gauge `name` to `value`."""
+    with lock:
+        values[_key(name, labels)] = value
+        types.setdefault(name, 'gauge')
+
+
+def observe(name, seconds, **labels):
+    """Add a single timing to the summary `name`."""
+    count_key = _key(name + '_count', labels)
+    sum_key = _key(name + '_sum', labels)
+    with lock:
+        values[count_key] = values.get(count_key, 0) + 1
+        values[sum_key] = values.get(sum_key, 0) + seconds
+        types.setdefault(name, 'summary')
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the body of a `with` block into the summary `name`."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorate a function to time every call into the summary `name`."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def cache_stats(cache, stats):
+    """Record the `stats()` of one of the caches as gauges."""
+    for stat in ['hits', 'misses', 'ratio']:
+        gauge('infoboard_cache_{0}'.format(stat), stats[stat], cache=cache)
+    gauge('infoboard_cache_entries',
+          stats.get('size', stats.get('entries')), cache=cache)
+
+
+def render():
+    """Everything recorded so far, in Prometheus' text format."""
+    with lock:
+        current = sorted(values.items())
+        kinds = dict(types)
+
+    lines = []
+    for name in sorted(kinds):
+        lines.append('# TYPE {0} {1}'.format(name, kinds[name]))
+        series = [name]
+        if kinds[name] == 'summary':
+            series = [name + suffix for suffix in SUMMARY_SUFFIXES]
+        for (metric, labels), value in current:
+            if metric in series:
+                lines.append('{0}{1} {2}'.format(metric, _labels(labels),
+                                                 _value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def write(path):
+    """Write `render()` to `path`, never leaving a half-written file."""
+    partial = '{0}.{1}'.format(path, os.getpid())
+    with open(partial, 'w') as metrics_file:
+        metrics_file.write(render())
+    os.rename(partial, path)
+
+
+@contextmanager
+def profiled(directory, prefix):
+    """Profile the body of a `with` block into `directory`, if given.
+
+    Each run is saved as its own <prefix>-<time>.prof, for pstats or
+    snakeviz.  Only the calling thread is profiled.
+    """
+    if not directory:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(os.path.join(directory, '{0}-{1}.prof'
+                                        .format(prefix, int(time.time()))))
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(label, _escape(value))
+                          for label, value in labels) + '}'
+
+
+def _escape(value):
+    return '{0}'.format(value).replace('\\', '\\\\') \
+                              .replace('"', '\\"') \
+                              .replace('\n', '\\n')
+
+
+def _value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '{0}'.format(value)
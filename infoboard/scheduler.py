@@ -0,0 +1,73 @@
+"""
+Decides whose feeds the scraper reads each cycle.  Members who were just
+active are checked again soon, idle ones less and less often, and the
+remaining hourly budget is spread out so the limit is never hit.
+"""
+from __future__ import unicode_literals
+
+import time
+
+
+class Scheduler(object):
+    def __init__(self, min_interval=60, max_interval=3600, backoff=2,
+                 reserve=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        # Share of the budget kept back for member lists and repositories.
+        self.reserve = reserve
+        self.next_poll = dict()
+        self.intervals = dict()
+        self.newest = dict()
+
+    def due(self, logins, now=None, limit=None):
+        """The logins whose feeds should be read now, most overdue first."""
+        now = now or time.time()
+        due = [login for login in logins
+               if self.next_poll.get(login, 0) <= now]
+        due.sort(key=lambda login: self.next_poll.get(login, 0))
+        if limit is not None:
+            due = due[:limit]
+        return due
+
+    def budget(self, remaining, reset, now=None):
+        """How many feeds can be read this cycle without running out before
+           the rate limit resets.
+        """
+        now = now or time.time()
+        usable = int(remaining) * (1 - self.reserve)
+        cycles = max((reset - now) / self.min_interval, 1)
+        return max(int(usable / cycles), 1)
+
+    def record(self, login, events, poll_interval=0, now=None):
+        """Schedule the next read of `login` after reading their feed.
+
+        Anyone with something new is checked again after the shortest
+        interval; otherwise the interval grows each time.  Github's own
+        X-Poll-Interval is never undercut.
+        """
+        now = now or time.time()
+        newest = events[0]['id'] if events else None
+        if newest is not None and newest != self.newest.get(login):
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals.get(login, self.min_interval)
+                           * self.backoff, self.max_interval)
+        interval = max(interval, poll_interval)
+        self.newest[login] = newest
+        self.intervals[login] = interval
+        self.next_poll[login] = now + interval
+
+    def active(self, login, now=None):
+        """Note that `login` turned up somewhere other than their feed."""
+        now = now or time.time()
+        self.intervals[login] = self.min_interval
+        self.next_poll[login] = now + self.min_interval
+
+    def sleep_time(self, now=None):
+        """How long to wait before the next cycle has anything to do."""
+        now = now or time.time()
+        if not self.next_poll:
+            return self.min_interval
+        wait = min(self.next_poll.values()) - now
+        return min(max(wait, self.min_interval), self.max_interval)
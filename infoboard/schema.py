@@ -0,0 +1,135 @@
+"""
+Tables infoboard keeps alongside the Knowledge entities.  They share
+Knowledge's metadata, so `metadata.create_all` creates them too.
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from sqlalchemy import (Column, Date, DateTime, Float, Index, Integer,
+                        LargeBinary, String, Text)
+
+from knowledge.model import DeclarativeBase, Entity
+
+# Knowledge leaves entity names unindexed.  `data.setup` adds this to
+# databases created before it was declared.
+entity_name_index = Index('ix_knowledge_entities_name', Entity.name)
+
+
+class CachedResponse(DeclarativeBase):
+    """The validators and body of the last good response for a URL."""
+    __tablename__ = 'infoboard_http_cache'
+
+    url = Column(String(255), primary_key=True)
+    etag = Column(String(255))
+    last_modified = Column(String(64))
+    payload = Column(Text)
+    fetched_at = Column(DateTime)
+
+
+class Event(DeclarativeBase):
+    """An indexed projection of each `event_*` entity.
+
+    The entity still holds everything about the event; this only carries
+    what is needed to find the right ones quickly.
+    """
+    __tablename__ = 'infoboard_events'
+
+    name = Column(String(64), primary_key=True)
+    created_at = Column(DateTime, nullable=False, index=True)
+    type = Column(String(64))
+    actor = Column(String(64))
+    repo = Column(String(255), index=True)
+    # Everything needed to draw the event, as JSON; see data.render_record.
+    render = Column(Text)
+    render_version = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_infoboard_events_actor_created_at', 'actor', 'created_at'),
+    )
+
+
+class Payload(DeclarativeBase):
+    """The payload of each cached event as Github sent it, as compressed JSON.
+
+    Entities only keep the parts infoboard uses (see data.compact_payload),
+    so this is only read when something needs the rest.
+    """
+    __tablename__ = 'infoboard_payloads'
+
+    name = Column(String(64), primary_key=True)
+    data = Column(LargeBinary)
+
+
+class Contribution(DeclarativeBase):
+    """Activity counted into hourly buckets as events are cached.
+
+    Users are counted per event type and repositories per actor, each with a
+    'count' row holding the total, so the week's top contributors can be
+    summed straight out of the DB.
+    """
+    __tablename__ = 'infoboard_contributions'
+
+    hour = Column(DateTime, primary_key=True)
+    kind = Column(String(8), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    detail = Column(String(255), primary_key=True)
+    count = Column(Float, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_infoboard_contributions_kind_detail_hour',
+              'kind', 'detail', 'hour'),
+    )
+
+
+class Missing(DeclarativeBase):
+    """Something Github couldn't find, and when to ask for it again."""
+    __tablename__ = 'infoboard_missing'
+
+    key = Column(String(255), primary_key=True)
+    failures = Column(Integer, nullable=False, default=1)
+    retry_at = Column(DateTime, nullable=False)
+
+
+class Rollup(DeclarativeBase):
+    """Daily totals of activity older than `Contribution`'s window.
+
+    Counted the same way, and rolled up from its buckets as they expire, so
+    old activity can still be summed once `data.compact` has deleted the
+    events themselves.
+    """
+    __tablename__ = 'infoboard_rollups'
+
+    day = Column(Date, primary_key=True)
+    kind = Column(String(8), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    detail = Column(String(255), primary_key=True)
+    count = Column(Float, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_infoboard_rollups_kind_key_day', 'kind', 'key', 'day'),
+    )
+
+
+class State(DeclarativeBase):
+    """Small bits of bookkeeping the scraper needs to remember."""
+    __tablename__ = 'infoboard_state'
+
+    key = Column(String(255), primary_key=True)
+    value = Column(Text)
+
+
+class Change(DeclarativeBase):
+    """A log of events whose render records were written, in order.
+
+    Frontends remember the last `seq` they saw and ask for what came after,
+    rather than re-reading everything.  SQLite would otherwise start `seq`
+    over once the log has been emptied.
+    """
+    __tablename__ = 'infoboard_changes'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(64), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.now,
+                        index=True)
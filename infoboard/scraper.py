@@ -6,38 +6,182 @@ use by the frontend(s).
 """
 
 from __future__ import unicode_literals
-from time import sleep
+from datetime import timedelta
+from itertools import chain, takewhile
+from time import sleep, time
 import logging
 import os
 
-from sqlalchemy import create_engine
-from knowledge.model import init_model, metadata, Entity
 import yaml
 
-from github import Github
+from github import Github, make_session
+from httpcache import NegativeCache, ValidatorCache
+from scheduler import Scheduler
+from shards import TokenPool
+import data
+import metrics
 
+# How often old events are compacted, if retention_days is set.
+COMPACT_INTERVAL = 24 * 60 * 60
 
-def cache_events(client, org):
-    """Pull new events from Github."""
+
+def cache_events(client, org, workers=1, scheduler=None, limit=None):
+    """Pull new events from Github, reading every member's feed.
+
+    Given a `scheduler`, only the feeds it says are due are read, up to
+    `limit` of them (by default, the scheduler's budget).  Feeds and
+    repositories are fetched by a pool of `workers` threads, but everything
+    they return is cached from this thread, one at a time.
+
+    Returns how many feeds were read.
+    """
 
     try:
         members = client.organization_members(org)
     except:
         logging.error('Error getting members')
-        return
+        return 0
+
+    # Entities stay on this thread; the workers only get logins.
+    logins = [user['login'] for user in members]
+    if scheduler:
+        if limit is None:
+            limit = _budget(client, scheduler)
+        logins = scheduler.due(logins, limit=limit)
+    _cache_feeds(client, logins, workers, scheduler=scheduler)
+    return len(logins)
+
+
+def cache_org_events(client, org, scheduler, workers=1, fallback=5,
+                     limit=None):
+    """Pull new events from Github, reading the organization's feed.
+
+    The feed is read down to the newest event seen last time.  Its events
+    only cover the organization's repositories, so up to `fallback` of the
+    members missing from it that `scheduler` says are due (and no more than
+    `limit`) also have their own feeds read, keeping the cost down to a
+    handful of calls.
+
+    Returns how many feeds were read, counting the organization's.
+    """
+
+    try:
+        members = client.organization_members(org)
+    except:
+        logging.error('Error getting members')
+        return 0
+
+    state_key = 'org_events:{0}'.format(org)
+    since = int(data.get_state(state_key, 0))
+    events = client.fetch_org_events(org, since)
 
-    client.broken_repos = ['/']
-    for user in members:
-        logging.debug("Looking up user {}".format(user))
-        events = client.user_activity(user['login'])
-        for event in events:
-            if not Entity.by_name(event['repo']):
-                client.repo_information(event['repo'])
+    active = set(event['actor']['login'] for event in events)
+    for login in active:
+        scheduler.active(login)
+    missing = [user['login'] for user in members
+               if user['login'] not in active]
+    if limit is None:
+        limit = _budget(client, scheduler)
+    logins = scheduler.due(missing, limit=max(min(fallback, limit - 1), 0))
 
+    _cache_feeds(client, logins, workers, events, scheduler)
+    if events:
+        data.set_state(state_key, events[0]['id'])
+    return len(logins) + 1
+
+
+def refresh_repos(client, ttl, workers=1, scheduler=None, limit=None):
+    """Fetch the details of this week's repositories again once they are
+       older than `ttl`, up to `limit` of them (by default, as far as the
+       scheduler's budget allows, or all of them without one).
+
+    Returns how many were fetched.
+    """
+    if limit is None and scheduler:
+        limit = _budget(client, scheduler)
+    if limit is not None and limit <= 0:
+        return 0
+    stale = data.stale_repos(ttl, limit or 0)
+    if stale:
+        logging.info("Refreshing {0} repositories".format(len(stale)))
+        data.ingest_repos(client.fetch_repos(stale, workers))
+    return len(stale)
+
+
+def _budget(client, scheduler):
+    return scheduler.budget(client.limiter.remaining, client.limiter.reset)
+
+
+def _cache_feeds(client, logins, workers, events=(), scheduler=None):
+    """Cache `events` and the feeds of `logins`, then any repositories
+       they mention that we don't know about yet.
+    """
+    # The newest event already cached from each member's feed.
+    newest = dict((login, int(event_id)) for login, event_id
+                  in data.get_states('feed:').items())
+    moved = dict()
+    repos = set()
+    feeds = chain([(None, events)], client.fetch_feeds(logins, workers))
+    for login, feed in feeds:
+        if scheduler and login:
+            scheduler.record(login, feed, client.poll_interval)
+        # Feeds are newest first, so everything after that is cached too.
+        fresh = list(takewhile(
+            lambda event: int(event['id']) > newest.get(login, 0), feed))
+        metrics.count('infoboard_feed_events_total', len(feed))
+        metrics.count('infoboard_feed_events_skipped_total',
+                      len(feed) - len(fresh))
+        if not fresh:
+            continue
+        if login:
+            moved[login] = fresh[0]['id']
+        data.ingest_events(fresh)
+        repos.update(event['repo']['name'] for event in fresh)
+
+    unknown_repos = repos - set(data.by_names(repos))
+    data.ingest_repos(client.fetch_repos(unknown_repos, workers))
+    data.set_states('feed:', moved)
+    data.expire_contributions()
+    data.expire_changes()
 
     logging.info("You have {0} of {1} calls left this hour."
           .format(*client.rate_limiting))
 
+    if client.missing:
+        client.missing.save()
+        logging.info("{entries} repositories and users missing, {skipped} "
+                     "requests for them skipped."
+                     .format(**client.missing.stats()))
+    if client.cache:
+        client.cache.save()
+        logging.info("Response cache: {hits} hits, {misses} misses, "
+                     "{entries} entries.".format(**client.cache.stats()))
+        metrics.cache_stats('http', client.cache.stats())
+    logging.info("Entity cache: {hits} hits, {misses} misses, "
+                 "{size} of {maxsize} entries."
+                 .format(**data.entity_cache.stats()))
+    metrics.cache_stats('entity', data.entity_cache.stats())
+
+
+def maintain(engine, retention_days, vacuum_days=0, now=None):
+    """Compact the DB, if it hasn't been for a day, and vacuum it as well if
+       it hasn't been for `vacuum_days`.
+    """
+    now = now or time()
+    if now - float(data.get_state('compacted_at', 0)) < COMPACT_INTERVAL:
+        return
+
+    deleted = data.compact(timedelta(days=retention_days))
+    vacuum = vacuum_days and \
+        now - float(data.get_state('vacuumed_at', 0)) >= vacuum_days * 86400
+    data.optimize(engine, vacuum)
+    logging.info("Compacted {0} old events{1}."
+                 .format(deleted, " and vacuumed the DB" if vacuum else ""))
+
+    data.set_state('compacted_at', now)
+    if vacuum:
+        data.set_state('vacuumed_at', now)
+
 
 if __name__ == '__main__':
     loglog = logging.getLogger()
@@ -47,16 +191,61 @@ if __name__ == '__main__':
     backend = conf['backend']
     common = conf['common']
 
+    organizations = common['organization']
+    if not isinstance(organizations, list):
+        organizations = [organizations]
+    workers = int(backend.get('workers', 1))
+    retries = int(backend.get('retries', 3))
+    tokens = [tuple(token.split(':', 1))
+              for token in backend.get('tokens') or []]
+    if tokens:
+        # Started before the DB is opened, so the workers never share it.
+        client = TokenPool(tokens, threads=max(workers, 1), retries=retries)
+
     # Set up Knowledge
-    engine = create_engine(common['db_uri'])
-    init_model(engine)
-    metadata.create_all(engine)
+    engine = data.setup(common['db_uri'], common.get('cache_size'))
+    data.migrate(engine)
+    cache = ValidatorCache()
+    missing = NegativeCache()
 
-    if backend['user'] and backend['password']:
-        client = Github((backend['user'], backend['password']))
+    # Only an explicit 0 turns refreshing off.
+    repo_ttl = backend.get('repo_ttl')
+    repo_ttl = timedelta(hours=int(24 if repo_ttl is None else repo_ttl))
+    scheduler = Scheduler(min_interval=int(backend.get('min_interval', 60)),
+                          max_interval=int(backend.get('max_interval', 3600)))
+    if tokens:
+        client.load_caches(cache, missing)
     else:
-        client = Github()
+        session = make_session(pool_size=max(workers, 1), retries=retries)
+        if backend['user'] and backend['password']:
+            client = Github((backend['user'], backend['password']),
+                            cache=cache, session=session, missing=missing)
+        else:
+            client = Github(cache=cache, session=session, missing=missing)
 
     while True:
-        cache_events(client, common['organization'])
-        sleep(common['interval'])
+        with metrics.timer('infoboard_scrape_cycle_seconds'), \
+             metrics.profiled(backend.get('profile_dir'), 'scraper'):
+            # One cycle's worth, shared between the organizations, with
+            # whatever they leave going to refreshing repositories.
+            budget = _budget(client, scheduler)
+            for index, org in enumerate(organizations):
+                share = max(budget // (len(organizations) - index), 1)
+                if backend.get('mode') == 'organization':
+                    used = cache_org_events(
+                        client, org, scheduler, workers=workers,
+                        fallback=int(backend.get('fallback', 5)),
+                        limit=share)
+                else:
+                    used = cache_events(client, org, workers=workers,
+                                        scheduler=scheduler, limit=share)
+                budget -= used
+            if repo_ttl:
+                refresh_repos(client, repo_ttl, workers, scheduler,
+                              limit=budget)
+        if backend.get('retention_days'):
+            maintain(engine, int(backend['retention_days']),
+                     int(backend.get('vacuum_days') or 0))
+        if backend.get('metrics_file'):
+            metrics.write(backend['metrics_file'])
+        sleep(scheduler.sleep_time())
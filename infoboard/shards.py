@@ -0,0 +1,209 @@
+"""
+Spreads the scraper's requests over several API tokens, each with a worker
+process of its own.
+
+Workers only talk to Github.  Everything they read comes back to the
+scraper's process, which stays the only one writing to the DB.  Each worker
+keeps its own token's rate limit, and reports it back so the scraper knows
+how much of each budget is left, along with whatever its response and
+negative caches learned, for the scraper to save.
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import multiprocessing
+import signal
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+import zlib
+
+from github import Github, make_session
+from httpcache import NegativeCache, ValidatorCache
+import data
+
+# The rate limit of every token put together, standing in for
+# `Github.limiter` when budgeting.
+Limits = namedtuple('Limits', ['remaining', 'reset'])
+
+# Each worker process's own client, and how many threads it reads with.
+client = None
+threads = 1
+
+
+def _start_worker(auth, worker_threads, retries):
+    global client, threads
+    # Ctrl-C is for the scraper to handle.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    threads = worker_threads
+    # Filled in by the scraper once it has read them from the DB.
+    client = Github(auth, cache=ValidatorCache(load=False),
+                    session=make_session(pool_size=threads, retries=retries),
+                    missing=NegativeCache(load=False))
+
+
+def _load_caches(validators, missing):
+    client.cache.merge(validators, save=False)
+    client.missing.merge(missing, save=False)
+
+
+def _report():
+    return ((client.limiter.remaining, client.limiter.reset,
+             client.rate_limiting, client.poll_interval),
+            client.cache.changes(), client.missing.changes())
+
+
+def _fetch_feeds(logins):
+    return list(client.fetch_feeds(logins, threads)), _report()
+
+
+def _fetch_repos(repo_names):
+    return list(client.fetch_repos(repo_names, threads)), _report()
+
+
+def _fetch_members(org_name):
+    return client.fetch_members(org_name), _report()
+
+
+def _fetch_org_events(org_name, since):
+    return client.fetch_org_events(org_name, since), _report()
+
+
+def _routed_name(url):
+    """The login or repository that requests for `url` are sent by, if they
+       are sent by name at all.
+    """
+    path = urlparse(url).path.split('/')
+    if len(path) == 4 and path[1] == 'users' and path[3] == 'events':
+        return path[2]
+    if len(path) == 4 and path[1] == 'repos':
+        return '{0}/{1}'.format(path[2], path[3])
+
+
+class TokenPool(object):
+    """Stands in for `Github` in the scraper, handing its requests to a
+       worker process per token in `tokens` ((user, token) pairs).
+
+    Feeds are read in batches of `threads`, each login always by the same
+    token so that its ETags are reused, unless that token has run out.
+    The workers start with empty caches until `load_caches` is called.
+    """
+    def __init__(self, tokens, threads=4, retries=3):
+        self.tokens = list(tokens)
+        self.threads = threads
+        self.pools = [multiprocessing.Pool(1, _start_worker,
+                                           (auth, threads, retries))
+                      for auth in self.tokens]
+        # (remaining, reset, (remaining, limit), poll interval) per token.
+        self.reports = [(5000, 0, (5000, 5000), 0)] * len(self.tokens)
+        # What the workers' caches learn is gathered here; see
+        # `load_caches`.
+        self.cache = None
+        self.missing = None
+
+    @property
+    def limiter(self):
+        return Limits(sum(report[0] for report in self.reports),
+                      max(report[1] for report in self.reports))
+
+    @property
+    def rate_limiting(self):
+        return (sum(int(report[2][0]) for report in self.reports),
+                sum(int(report[2][1]) for report in self.reports))
+
+    @property
+    def poll_interval(self):
+        return max(report[3] for report in self.reports)
+
+    def load_caches(self, cache, missing):
+        """Keep what the workers' caches learn in `cache` and `missing`,
+           which the scraper loads from the DB and saves.
+
+        Each worker is handed the entries for the logins and repositories
+        its requests are sent by.  Everything else (e.g. members and
+        organization feeds, which go to whichever token has the most calls
+        left) goes to every worker.
+        """
+        self.cache = cache
+        self.missing = missing
+        validators = [dict() for _ in self.pools]
+        for url, entry in cache.entries.items():
+            name = _routed_name(url)
+            for index in self._indexes(name):
+                validators[index][url] = entry
+        misses = [dict() for _ in self.pools]
+        for key, entry in missing.entries.items():
+            for index in self._indexes(key.split(':', 1)[-1]):
+                misses[index][key] = entry
+        for pool, shard, missed in zip(self.pools, validators, misses):
+            pool.apply(_load_caches, (shard, missed))
+
+    def fetch_members(self, org_name):
+        return self._call(_fetch_members, org_name)
+
+    def fetch_org_events(self, org_name, since=0):
+        return self._call(_fetch_org_events, org_name, since)
+
+    def organization_members(self, org_name):
+        return data.ingest_users(self.fetch_members(org_name))
+
+    def fetch_feeds(self, logins, workers=None):
+        """The feeds of `logins` as (login, events) pairs, batch by batch."""
+        return self._scatter(_fetch_feeds, logins)
+
+    def fetch_repos(self, repo_names, workers=None):
+        return self._scatter(_fetch_repos, repo_names)
+
+    def _call(self, function, *args):
+        # Whichever token has the most calls left.
+        index = max(range(len(self.pools)),
+                    key=lambda index: self.reports[index][0])
+        result, report = self.pools[index].apply(function, args)
+        self._update(index, report)
+        return result
+
+    def _scatter(self, function, names):
+        """Call `function` on batches of `names` across the workers, and
+           yield everything it returns.
+        """
+        batches = []
+        for index, shard in enumerate(self._partition(names)):
+            for start in range(0, len(shard), self.threads):
+                batch = shard[start:start + self.threads]
+                batches.append((index, self.pools[index].apply_async(
+                    function, (batch,))))
+        for index, result in batches:
+            results, report = result.get()
+            self._update(index, report)
+            for item in results:
+                yield item
+
+    def _update(self, index, report):
+        self.reports[index], validators, missing = report
+        if self.cache:
+            self.cache.merge(*validators)
+        if self.missing:
+            self.missing.merge(*missing)
+
+    def _index(self, name):
+        """The worker requests for `name` go to, while it has calls left."""
+        return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) \
+            % len(self.pools)
+
+    def _indexes(self, name):
+        if name is None:
+            return range(len(self.pools))
+        return [self._index(name)]
+
+    def _partition(self, names):
+        shards = [[] for _ in self.pools]
+        remaining = [report[0] for report in self.reports]
+        for name in names:
+            index = self._index(name)
+            if remaining[index] <= 0:
+                # Out of calls; borrow from whichever token has the most.
+                index = remaining.index(max(remaining))
+            remaining[index] -= 1
+            shards[index].append(name)
+        return shards
@@ -0,0 +1,257 @@
+# -*- coding: UTF-8 -*-
+"""
+Everything the board shows, worked out ahead of time.
+
+The board's widgets only ever see these immutable views, which are built on
+a background thread so that the DB is never touched from the GTK main loop.
+Their text is Pango markup, and everything from Github is escaped here, as
+it is put into it, and nowhere else.
+"""
+from __future__ import unicode_literals
+
+from xml.sax.saxutils import escape
+
+from views import EventView, HilightView, Snapshot
+import data
+import metrics
+
+# Events not worth showing at all.
+BLACKLIST = ['DownloadEvent']
+
+
+@metrics.timed('infoboard_snapshot_seconds', kind='full')
+def build_snapshot(max_events, max_users, max_repos):
+    events = [event_view(name, created_at, record)
+              for name, event_type, created_at, record
+              in data.recent_renders(limit=max_events)
+              if event_type not in BLACKLIST]
+    users, repos = _hilights(max_users, max_repos)
+    return Snapshot(tuple(events), users, repos)
+
+
+@metrics.timed('infoboard_snapshot_seconds', kind='update')
+def update_snapshot(snapshot, changed, max_events, max_users, max_repos):
+    """A copy of `snapshot` with the events named in `changed` (new or
+       redrawn) worked in.  Nothing else about the events is re-read.
+    """
+    events = dict((view.name, view) for view in snapshot.events)
+    for name, event_type, created_at, record in data.event_renders(changed):
+        if event_type not in BLACKLIST:
+            events[name] = event_view(name, created_at, record)
+    events = sorted(events.values(), key=lambda view: view.created_at,
+                    reverse=True)
+    users, repos = _hilights(max_users, max_repos)
+    return Snapshot(tuple(events[:max_events]), users, repos)
+
+
+def catch_up(snapshot, seq, max_events, max_users, max_repos, full=False):
+    """Bring `snapshot`, built as of change `seq` in the scraper's change
+       log, up to date.  Returns the new snapshot and change.
+
+    Everything is built again when `full` is set or there is no snapshot
+    yet; otherwise only the events that changed are read again.  If
+    nothing did, `snapshot` itself comes back.
+    """
+    latest = data.latest_change()
+    # A lower number means the change log was started over.
+    if full or snapshot is None or latest < seq:
+        snapshot = build_snapshot(max_events, max_users, max_repos)
+    elif latest > seq:
+        snapshot = update_snapshot(snapshot, data.changes_since(seq),
+                                   max_events, max_users, max_repos)
+    return snapshot, latest
+
+
+def _hilights(max_users, max_repos):
+    top_users, top_repos = data.top_contributions(max_users, max_repos)
+    sorted_users = sorted(top_users,
+                          key=lambda user: top_users[user]['count'],
+                          reverse=True)
+    sorted_repos = sorted(top_repos,
+                          key=lambda repo: top_repos[repo]['count'],
+                          reverse=True)
+    users = [user_view(user_id, top_users[user_id])
+             for user_id in sorted_users[:max_users]]
+    repos = [repo_view(repo_id, top_repos[repo_id])
+             for repo_id in sorted_repos[:max_repos]]
+    return tuple(users), tuple(repos)
+
+
+def event_view(name, created_at, record):
+    """Lay out an event from its render record (see data.render_record)."""
+    avatar = record['actor']['avatar']
+    record = _escaped(record)
+    user_name = record['actor']['name']
+    payload = record['payload']
+    repo = record['repo']
+
+    if 'url' not in repo:
+        repo_link = repo['name']
+        repo_desc = ''
+    else:
+        repo_link = '<a href="{0}">{1}</a>'.format(repo['url'], repo['name'])
+        repo_desc = repo['description']
+
+    event_colors = {
+        'commit': "#C9FFC1",
+        'branch': "#C2C9FF",
+        'issue': "#FFBAF9",
+        'comment': "#FFDDBD",
+        'social': "#FFFF80",
+    }
+    event_text = []
+    color = "#FFFFFF"
+    event_type = record['type']
+    if event_type == "CommitCommentEvent":
+        color = event_colors['comment']
+        event_text.append("{0} commented on a commit in {1}."
+            .format(user_name, repo_link))
+        event_text.append(record.get('comment', ''))
+    elif event_type == "CreateEvent":
+        color = event_colors['branch']
+        new_type = payload['ref_type']
+        if new_type == 'repository':
+            event_text.append("{0} created a new {1}, {2}."
+                .format(user_name, new_type, repo_link))
+        else:
+            event_text.append("{0} created {1} <tt>{3}</tt> in {2}."
+                .format(user_name, new_type, repo_link, payload['ref']))
+        event_text.append(repo_desc)
+    elif event_type == "DeleteEvent":
+        color = event_colors['branch']
+        event_text.append("{0} deleted {1} <tt>{3}</tt> in {2}."
+            .format(user_name, payload['ref_type'], repo_link,
+                    payload['ref']))
+    #DownloadEvent
+    elif event_type == "FollowEvent":
+        color = event_colors['social']
+        event_text.append("{0} is now following {1}."
+            .format(user_name, payload['target']))
+    elif event_type == "ForkEvent":
+        color = event_colors['branch']
+        event_text.append("{0} forked {1} to {2}."
+            .format(user_name, repo_link, payload['forkee']))
+        event_text.append(repo_desc)
+    #ForkApplyEvent
+    elif event_type == "GistEvent":
+        event_text.append("{0} {1}d a gist"
+            .format(user_name, payload['action']))
+    elif event_type == "GollumEvent":
+        event_text.append("{0} updated {2} wiki pages in {1}."
+                          .format(user_name, repo_link,
+                                  len(payload['pages'])))
+        event_text.extend(payload['pages'])
+    elif event_type == "IssueCommentEvent":
+        color = event_colors['comment']
+        issue = record['issue']
+        event_text.append("{0} commented on issue #{1} in {2}."
+            .format(user_name, issue['number'], repo_link))
+        event_text.append(issue['title'])
+        event_text.append(record.get('comment', ''))
+    elif event_type == "IssuesEvent":
+        color = event_colors['issue']
+        issue = record['issue']
+        event_text.append("{0} {1} issue #{2} in {3}."
+            .format(user_name, payload['action'], issue['number'],
+                    repo_link))
+        event_text.append(issue['title'])
+    elif event_type == "MemberEvent":
+        color = event_colors['social']
+        event_text.append("{0} added {1} as a collaborator to {2}."
+            .format(user_name, payload['member'], repo_link))
+        event_text.append(repo_desc)
+    elif event_type == "PublicEvent":
+        event_text.append("{0} made {1} public."
+                          .format(user_name, repo_link))
+        event_text.append(repo_desc)
+    elif event_type == "PullRequestEvent":
+        color = event_colors['issue']
+        event_text.append("{0} {1} pull request #{2} in {3}."
+            .format(user_name, payload['action'], payload['number'],
+                    repo_link))
+    elif event_type == 'PullRequestReviewCommentEvent':
+        color = event_colors['social']
+        event_text.append("{0} commented on an issue in {1}."
+                          .format(user_name, repo_link))
+        event_text.append(record.get('comment', ''))
+    elif event_type == "PushEvent":
+        color = event_colors['commit']
+        commits = record['commits']
+        event_text.append("{0} pushed {1} commit(s) to {2}."
+            .format(user_name, len(commits), repo_link))
+        for message in commits:
+            event_text.append(u'• ' + message)
+    #TeamAddEvent
+    elif event_type == "WatchEvent":
+        color = event_colors['social']
+        event_text.append("{0} is now watching {1}"
+            .format(user_name, repo_link))
+        event_text.append(repo_desc)
+    else:
+        event_text.append(event_type)
+
+    return EventView(name, event_type, created_at, color, avatar,
+                     '\n'.join(event_text))
+
+
+def _escaped(value):
+    """`value` with every string in it escaped for markup."""
+    if isinstance(value, dict):
+        return dict((key, _escaped(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_escaped(item) for item in value]
+    if isinstance(value, basestring):
+        return escape(value, {'"': '&quot;'})
+    return value
+
+
+def user_view(user_id, user_info):
+    user = data.entity(user_id)
+    display_key = {
+        'CommitCommentEvent': ('commented on', 'commits'),
+        'CreateEvent': ('created', 'tags, branches, or repositories'),
+        'DeleteEvent': ('deleted', 'tags, branches, or repositories'),
+        # DownloadEvent
+        'FollowEvent': ('followed', 'users'),
+        'ForkEvent': ('forked', 'repositories'),
+        'ForkApplyEvent': ('applied', 'patches'),
+        'GistEvent': ('made or modified', 'gists'),
+        'GollumEvent': ('made or modified', 'wiki pages'),
+        'IssueCommentEvent': ('commented on', 'issues'),
+        'IssuesEvent': ('made or modified', 'issues'),
+        'MemberEvent': ('added', 'collaborators'),
+        'PublicEvent': ('opened', 'repositories'),
+        'PullRequestEvent': ('made or modified', 'pull requests'),
+        'PullRequestReviewCommentEvent': ('commented on', 'pull requests'),
+        'PushEvent': ('pushed', 'commits'),
+        'TeamAddEvent': ('added', 'users to teams'),
+        'WatchEvent': ('watched', 'repositories'),
+    }
+
+    user_name = _escaped(user['name'])
+    text = ["{0} has been very busy this week!".format(user_name)]
+    for event_type, count in user_info.items():
+        if event_type == 'count':
+            continue
+        elif event_type in data.SOCIAL_EVENTS:
+            count = int(count * 10)
+        display_text = display_key.get(event_type, ('made', event_type))
+        text.append("{0} {1[0]} {2} {1[1]} this week."
+            .format(user_name, display_text, count, event_type))
+
+    return HilightView(user_id, user['avatar'], '\n'.join(text))
+
+
+def repo_view(repo_id, repo_info):
+    repo = data.entity(repo_id)
+    owner = data.entity(repo['owner'])
+
+    text = ["{0} is a cool project!".format(_escaped(repo['name']))]
+    for user, count in repo_info.items():
+        if user == 'count':
+            continue
+        text.append("{0} made {1} contributions this week."
+            .format(_escaped(data.entity(user)['name']), count))
+
+    avatar = owner['avatar'] if owner else None
+    return HilightView(repo_id, avatar, '\n'.join(text))
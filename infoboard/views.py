@@ -0,0 +1,64 @@
+"""
+The immutable views the board is drawn from, and a file to keep the last
+ones in.
+
+The board draws whatever it drew last time from that file as soon as it
+starts, before the DB has even been opened, so nothing heavier than the
+standard library is imported here.
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from datetime import datetime
+import json
+import logging
+import os
+
+# A single event on the left of the board.
+EventView = namedtuple('EventView', ['name', 'type', 'created_at', 'color',
+                                     'avatar', 'text'])
+# A spotlighted user or repository on the right.
+HilightView = namedtuple('HilightView', ['name', 'avatar', 'text'])
+# Everything on the board at one point in time.
+Snapshot = namedtuple('Snapshot', ['events', 'users', 'repos'])
+
+# Bump whenever the views change, so old files are ignored.
+FILE_VERSION = 1
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def save_snapshot(snapshot, path):
+    """Write `snapshot` to `path`, never leaving a half-written file.
+
+    Avatars are kept as their URLs; `AvatarLoader` finds the pictures
+    already on disk from those.
+    """
+    events = [view._replace(created_at=view.created_at.strftime(TIME_FORMAT))
+              for view in snapshot.events]
+    contents = dict(version=FILE_VERSION, events=events,
+                    users=snapshot.users, repos=snapshot.repos)
+    partial = '{0}.{1}'.format(path, os.getpid())
+    with open(partial, 'w') as snapshot_file:
+        json.dump(contents, snapshot_file, separators=(',', ':'))
+    os.rename(partial, path)
+
+
+def load_snapshot(path):
+    """The snapshot saved at `path`, or None if there isn't a usable one."""
+    try:
+        with open(path) as snapshot_file:
+            contents = json.load(snapshot_file)
+        if not isinstance(contents, dict) or \
+                contents.get('version') != FILE_VERSION:
+            return None
+        events = [EventView(*view) for view in contents['events']]
+        events = [view._replace(created_at=datetime.strptime(
+                      view.created_at, TIME_FORMAT)) for view in events]
+        users = [HilightView(*view) for view in contents['users']]
+        repos = [HilightView(*view) for view in contents['repos']]
+        return Snapshot(tuple(events), tuple(users), tuple(repos))
+    except (IOError, ValueError, TypeError, KeyError, AttributeError) as e:
+        if os.path.exists(path):
+            logging.warning("Could not read the last snapshot: {0}".format(e))
+        return None
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+A headless frontend that serves the board as JSON over HTTP.
+
+Responses are built once, on a single background thread, whenever the
+scraper's change log moves, and every request is answered from memory.
+Clients that send back the ETag they were given get a 304 until something
+changes, so any number of displays can poll it cheaply.
+"""
+from __future__ import unicode_literals
+
+from hashlib import sha1
+import json
+import logging
+import os
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import yaml
+
+import data
+import metrics
+import viewmodel
+
+# How many days of activity /history covers.
+HISTORY_DAYS = 30
+
+
+class Board(object):
+    """The current JSON responses, kept up to date from the DB."""
+    def __init__(self, max_events, max_users, max_repos,
+                 interval=360, notify_interval=5):
+        self.max_events = max_events
+        self.max_users = max_users
+        self.max_repos = max_repos
+        self.interval = interval
+        self.notify_interval = notify_interval
+        # path -> (body, etag); replaced wholesale, never modified.
+        self.responses = dict()
+
+    def get(self, path):
+        return self.responses.get(path)
+
+    def run(self):
+        """Keep the responses current.  Runs forever on its own thread."""
+        snapshot = None
+        seq = 0
+        rebuilt = 0
+        while True:
+            try:
+                full = time.time() - rebuilt > self.interval
+                fresh, seq = viewmodel.catch_up(
+                    snapshot, seq, self.max_events, self.max_users,
+                    self.max_repos, full)
+                if full:
+                    rebuilt = time.time()
+                if fresh is not snapshot:
+                    snapshot = fresh
+                    self.publish(snapshot, self.history(snapshot))
+            except Exception:
+                logging.exception("Could not load the board")
+            time.sleep(self.notify_interval)
+
+    def history(self, snapshot):
+        history = data.daily_contributions(
+            'user', [view.name for view in snapshot.users], HISTORY_DAYS)
+        history.update(data.daily_contributions(
+            'repo', [view.name for view in snapshot.repos], HISTORY_DAYS))
+        return history
+
+    def publish(self, snapshot, history=None):
+        """Work out every response from `snapshot`, along with the daily
+           `history` of the users and repositories in it, if given.
+        """
+        events = [view._asdict() for view in snapshot.events]
+        for event in events:
+            event['created_at'] = event['created_at'].isoformat() + 'Z'
+        users = [view._asdict() for view in snapshot.users]
+        repos = [view._asdict() for view in snapshot.repos]
+
+        bodies = {
+            '/events': events,
+            '/users': users,
+            '/repos': repos,
+            '/': dict(events=events, users=users, repos=repos),
+        }
+        if history is not None:
+            bodies['/history'] = dict(
+                (name, dict((day.isoformat(), count)
+                            for day, count in days.items()))
+                for name, days in history.items())
+        responses = dict()
+        for path, body in bodies.items():
+            body = json.dumps(body).encode('utf-8')
+            responses[path] = (body, '"{0}"'.format(sha1(body).hexdigest()))
+        self.responses = responses
+
+
+class BoardHandler(BaseHTTPRequestHandler):
+    board = None
+    max_age = 5
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/') or '/'
+        if path == '/metrics':
+            self.send_metrics()
+            return
+
+        response = self.board.get(path)
+        if response is None:
+            if not self.board.responses:
+                # Still working out the first snapshot.
+                self.send_response(503)
+                self.send_header('Retry-After', str(self.max_age))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_error(404)
+            return
+
+        body, etag = response
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'max-age={0}'.format(self.max_age))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_metrics(self):
+        metrics.cache_stats('entity', data.entity_cache.stats())
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    yaml_location = os.path.join(os.path.split(__file__)[0], 'settings.yaml')
+    with open(yaml_location) as yaml_file:
+        conf = yaml.load(yaml_file)
+    client = conf['client']
+    common = conf['common']
+    web = conf.get('web', dict())
+
+    # Set up Knowledge
+    data.setup(common['db_uri'], common.get('cache_size'))
+
+    notify_interval = float(client.get('notify_interval', 5))
+    board = Board(int(client['events']), int(client['users']),
+                  int(client['repositories']),
+                  interval=int(common['interval']),
+                  notify_interval=notify_interval)
+    worker = threading.Thread(target=board.run)
+    worker.daemon = True
+    worker.start()
+
+    BoardHandler.board = board
+    BoardHandler.max_age = int(notify_interval)
+    server = ThreadingHTTPServer((web.get('host', 'localhost'),
+                                  int(web.get('port', 8080))),
+                                 BoardHandler)
+    logging.info("Serving the board on http://{0}:{1}/"
+                 .format(*server.server_address))
+    server.serve_forever()
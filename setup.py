@@ -13,5 +13,6 @@ setup(
     install_requires=['requests',
                       'knowledge',
                       'pyyaml',
-                     ]
+                     ],
+    extras_require={'fast': ['ujson']},
 )
@@ -0,0 +1,12 @@
+"""
+Tests for infoboard, run with `python -m unittest discover` from the top of
+the repository.
+
+The modules under infoboard/ import each other by their bare names, as they
+do when run as scripts, so that directory is put on the path here.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'infoboard'))
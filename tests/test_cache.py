@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+
+import time
+import unittest
+
+from cache import LRUCache, MISSING
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_forgets_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_none_is_cached(self):
+        cache = LRUCache()
+        cache.put('gone', None)
+        self.assertIsNone(cache.get('gone'))
+        self.assertEqual(cache.get('other', 'default'), 'default')
+
+    def test_expires(self):
+        cache = LRUCache(ttl=0.05)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(len(cache), 0)
+
+    def test_stats(self):
+        cache = LRUCache(maxsize=10)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.invalidate('a')
+        self.assertEqual(cache.stats(), dict(hits=1, misses=1, ratio=0.5,
+                                             size=0, maxsize=10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,422 @@
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from xml.sax.saxutils import escape
+
+from knowledge.model import DBSession, Entity, Fact
+
+from benchmark import CommitCounter, SyntheticOrg
+import data
+from schema import Change, Contribution, Event, Rollup, State
+
+
+def escape_everything():
+    """Store everything the way older versions did."""
+    for fact in DBSession.query(Fact):
+        if fact.char_value is not None:
+            fact.char_value = escape(fact.char_value)
+        elif fact.key == 'payload':
+            payload = dict(fact.dict_value)
+            payload['commits'] = [dict(commit,
+                                       message=escape(commit['message']))
+                                  for commit in payload['commits']]
+            fact.dict_value = payload
+    DBSession.query(State).filter(State.key == 'unescaped').delete()
+    DBSession.commit()
+    data.entity_cache.clear()
+
+
+class DBTestCase(unittest.TestCase):
+    """Gives each test a fresh in-memory DB."""
+    def setUp(self):
+        DBSession.remove()
+        data.entity_cache.clear()
+        self.engine = data.setup('sqlite://')
+        data.migrate(self.engine)
+
+    def tearDown(self):
+        DBSession.remove()
+        data.entity_cache.clear()
+
+
+class StateTest(DBTestCase):
+    def test_prefixes_are_literal(self):
+        data.set_states('feed:', {'some_one': 3, 'other': 4})
+        data.set_state('feedXsome', 5)
+        data.set_state('feed:_%', 6)
+        self.assertEqual(data.get_states('feed:'),
+                         {'some_one': '3', 'other': '4', '_%': '6'})
+        self.assertEqual(data.get_states('feed:_'), {'%': '6'})
+
+
+class TopContributionsTest(DBTestCase):
+    def setUp(self):
+        super(TopContributionsTest, self).setUp()
+        self.org = SyntheticOrg(members=6, repos=8)
+        data.ingest_events(self.org.generate(200, spread=timedelta(days=2)))
+
+    def test_users_are_limited(self):
+        everyone, _ = data.top_contributions()
+        top, _ = data.top_contributions(users=2)
+        self.assertEqual(len(top), 2)
+        busiest = sorted(everyone,
+                         key=lambda user: (-everyone[user]['count'], user))
+        self.assertEqual(sorted(top), sorted(busiest[:2]))
+
+    def test_unknown_repos_are_skipped(self):
+        names = sorted(self.org.repos)
+        known = names[::2]
+        data.ingest_repos(self.org.repos[name] for name in known)
+        _, everything = data.top_contributions(repos=len(names))
+        self.assertEqual(sorted(everything), known)
+        _, top = data.top_contributions(repos=3)
+        self.assertEqual(len(top), 3)
+        busiest = sorted(everything,
+                         key=lambda repo: (-everything[repo]['count'], repo))
+        self.assertEqual(sorted(top), sorted(busiest[:3]))
+
+
+class RenderTest(DBTestCase):
+    def setUp(self):
+        super(RenderTest, self).setUp()
+        self.org = SyntheticOrg(members=3, repos=2)
+        self.events = self.org.generate(10, spread=timedelta(hours=1))
+        data.ingest_events(self.events)
+
+    def test_records_match_the_events(self):
+        renders = data.recent_renders()
+        self.assertEqual([name for name, _, _, _ in renders],
+                         ['event_{0}'.format(event['id'])
+                          for event in reversed(self.events)])
+        for (_, event_type, _, record), event in zip(renders,
+                                                     reversed(self.events)):
+            self.assertEqual(record['type'], event_type)
+            self.assertEqual(record['actor']['name'], event['actor']['login'])
+            self.assertEqual(record['repo']['name'], event['repo']['name'])
+
+    def test_repo_details_are_filled_in_later(self):
+        data.ingest_repos(self.org.repos.values())
+        for _, _, _, record in data.recent_renders():
+            repo = self.org.repos[record['repo']['name']]
+            self.assertEqual(record['repo']['description'],
+                             repo['description'])
+
+    def test_stale_orphans_are_skipped(self):
+        DBSession.query(Event).update({'render_version': 0})
+        DBSession.commit()
+        name = 'event_{0}'.format(self.events[-1]['id'])
+        orphan = DBSession.query(Entity).filter(Entity.name == name).one()
+        data._delete_entities([orphan.id])
+        DBSession.commit()
+        data.forget([name])
+
+        names = [render[0] for render in data.recent_renders()]
+        self.assertEqual(len(names), len(self.events) - 1)
+        self.assertNotIn(name, names)
+
+
+class ChangeLogTest(DBTestCase):
+    def setUp(self):
+        super(ChangeLogTest, self).setUp()
+        self.org = SyntheticOrg(members=3, repos=2)
+
+    def ingest(self, count):
+        events = self.org.generate(count, spread=timedelta(hours=1))
+        data.ingest_events(events)
+        return set('event_{0}'.format(event['id']) for event in events)
+
+    def test_changes_since(self):
+        self.assertEqual(data.latest_change(), 0)
+        first = self.ingest(3)
+        seq = data.latest_change()
+        self.assertEqual(data.changes_since(0), first)
+        second = self.ingest(2)
+        self.assertEqual(data.changes_since(seq), second)
+        self.assertEqual(data.changes_since(data.latest_change()), set())
+
+    def test_sequence_survives_expiry(self):
+        self.ingest(3)
+        seq = data.latest_change()
+        DBSession.query(Change).update(
+            {'created_at': datetime.now() - timedelta(days=2)})
+        DBSession.commit()
+        data.expire_changes()
+        self.assertEqual(data.latest_change(), 0)
+
+        fresh = self.ingest(1)
+        self.assertGreater(data.latest_change(), seq)
+        self.assertEqual(data.changes_since(seq), fresh)
+
+    def test_old_change_log_is_recreated(self):
+        self.engine.execute('DROP TABLE infoboard_changes')
+        self.engine.execute('CREATE TABLE infoboard_changes ('
+                            'seq INTEGER PRIMARY KEY, '
+                            'name VARCHAR(64) NOT NULL, '
+                            'created_at DATETIME NOT NULL)')
+        data.upgrade(self.engine)
+        sql = self.engine.execute("SELECT sql FROM sqlite_master "
+                                  "WHERE name = 'infoboard_changes'").scalar()
+        self.assertIn('AUTOINCREMENT', sql)
+
+
+class MetadataTest(DBTestCase):
+    def setUp(self):
+        super(MetadataTest, self).setUp()
+        self.org = SyntheticOrg(members=3, repos=3)
+        data.ingest_events(self.org.generate(30, spread=timedelta(hours=5)))
+        self.commits = CommitCounter(self.engine)
+
+    def test_unchanged_users_are_not_written(self):
+        data.ingest_users(self.org.members)
+        self.assertEqual(self.commits.count, 0)
+
+    def test_names_are_kept(self):
+        user = dict(self.org.members[0], name='Real Name')
+        data.ingest_users([user])
+        data.ingest_users(self.org.members)
+        data.entity_cache.clear()
+        self.assertEqual(data.entity('user_{0}'.format(user['id']))['name'],
+                         'Real Name')
+
+    def test_only_changed_repos_are_rendered_again(self):
+        data.ingest_repos(self.org.repos.values())
+        seq = data.latest_change()
+        data.ingest_repos(self.org.repos.values())
+        self.assertEqual(data.changes_since(seq), set())
+
+        name = sorted(self.org.repos)[0]
+        self.org.repos[name]['description'] = 'Something else'
+        data.ingest_repos(self.org.repos.values())
+        changed = data.changes_since(seq)
+        self.assertTrue(changed)
+        self.assertEqual(set(row.repo for row in DBSession.query(Event)
+                             .filter(Event.name.in_(changed))), set([name]))
+
+    def test_stale_repos(self):
+        self.assertEqual(data.stale_repos(timedelta(hours=1)), [])
+        data.ingest_repos(self.org.repos.values())
+        self.assertEqual(data.stale_repos(timedelta(hours=1)), [])
+        self.assertEqual(sorted(data.stale_repos(timedelta(0))),
+                         sorted(self.org.repos))
+        self.assertEqual(len(data.stale_repos(timedelta(0), limit=2)), 2)
+
+
+class UnescapeTest(DBTestCase):
+    def setUp(self):
+        super(UnescapeTest, self).setUp()
+        self.org = SyntheticOrg(members=2, repos=1,
+                                mix={'PushEvent': 1})
+        self.events = self.org.generate(3, spread=timedelta(hours=1))
+        for event in self.events:
+            for commit in event['payload']['commits']:
+                commit['message'] = 'Fix a < b && c > d'
+                commit['distinct'] = True
+        repo = list(self.org.repos.values())[0]
+        repo['description'] = 'Tools for <you> & me'
+        data.ingest_events(self.events)
+        data.ingest_repos([repo])
+
+    def test_facts_are_unescaped(self):
+        before = data.recent_renders()
+        escape_everything()
+        repo = data.entity(sorted(self.org.repos)[0])
+        self.assertEqual(repo['description'], 'Tools for &lt;you&gt; &amp; me')
+
+        data.unescape_facts()
+        data.entity_cache.clear()
+        repo = data.entity(sorted(self.org.repos)[0])
+        self.assertEqual(repo['description'], 'Tools for <you> & me')
+        for event in data.recent_events():
+            for commit in event['payload']['commits']:
+                self.assertEqual(commit['message'], 'Fix a < b && c > d')
+
+        DBSession.query(Event).update({'render_version': 0})
+        DBSession.commit()
+        data.rerender_events()
+        self.assertEqual(data.recent_renders(), before)
+
+    def test_only_once(self):
+        data.unescape_facts()
+        repo = data.entity(sorted(self.org.repos)[0])
+        repo['description'] = '&amp; literally'
+        DBSession.commit()
+        data.unescape_facts()
+        data.entity_cache.clear()
+        self.assertEqual(data.entity(sorted(self.org.repos)[0])['description'],
+                         '&amp; literally')
+
+
+class PayloadTest(DBTestCase):
+    def test_compact_payloads_render_the_same(self):
+        org = SyntheticOrg(members=4, repos=2)
+        events = org.generate(100, spread=timedelta(hours=5))
+        data.ingest_events(events)
+        renders = data.recent_renders()
+        for event in events:
+            name = 'event_{0}'.format(event['id'])
+            self.assertEqual(data.full_payload(name), event['payload'])
+            compact = data.entity(name)['payload']
+            if event['type'] == 'PushEvent':
+                self.assertEqual(data._distinct_commits(compact),
+                                 data._distinct_commits(event['payload']))
+
+        DBSession.query(Event).update({'render_version': 0})
+        DBSession.commit()
+        data.rerender_events()
+        self.assertEqual(data.recent_renders(), renders)
+
+
+class RollupTest(DBTestCase):
+    def setUp(self):
+        super(RollupTest, self).setUp()
+        self.org = SyntheticOrg(members=4, repos=3)
+        # Some of it older than the hourly window, some of it inside.
+        self.events = self.org.generate(150, spread=timedelta(days=20))
+        data.ingest_events(self.events)
+
+    def totals(self, kind, days=30):
+        keys = set(key for key, in DBSession.query(Contribution.key)
+                                            .filter(Contribution.kind == kind))
+        keys.update(key for key, in DBSession.query(Rollup.key)
+                                             .filter(Rollup.kind == kind))
+        history = data.daily_contributions(kind, keys, days)
+        return dict((key, round(sum(days.values()), 6))
+                    for key, days in history.items())
+
+    def expected(self, kind):
+        totals = dict()
+        for event in data.recent_events():
+            for this, key, detail, changes in data._contributions(
+                    event, event['payload']):
+                if this == kind and detail == 'count':
+                    totals[key] = totals.get(key, 0) + changes
+        return dict((key, round(total, 6)) for key, total in totals.items())
+
+    def test_history_covers_everything(self):
+        self.assertTrue(DBSession.query(Rollup).count())
+        self.assertEqual(self.totals('user'), self.expected('user'))
+        self.assertEqual(self.totals('repo'), self.expected('repo'))
+
+    def test_expired_hours_are_rolled_up(self):
+        expected = self.totals('user')
+        # As if over a week had gone by, including for the current hour.
+        rows = [(row.hour - timedelta(days=8), row.kind, row.key, row.detail,
+                 row.count) for row in DBSession.query(Contribution)]
+        DBSession.query(Contribution).delete()
+        for hour, kind, key, detail, count in rows:
+            DBSession.add(Contribution(hour=hour, kind=kind, key=key,
+                                       detail=detail, count=count))
+        DBSession.commit()
+        data.expire_contributions()
+        self.assertEqual(DBSession.query(Contribution).count(), 0)
+        self.assertEqual(self.totals('user', days=40), expected)
+
+    def test_compaction_keeps_totals(self):
+        users, repos = self.totals('user'), self.totals('repo')
+        self.assertTrue(data.compact(timedelta(days=7)))
+        self.assertEqual(self.totals('user'), users)
+        self.assertEqual(self.totals('repo'), repos)
+
+    def test_backfill(self):
+        DBSession.query(Rollup).delete()
+        DBSession.query(State).filter(State.key == 'rolled_up').delete()
+        DBSession.commit()
+        data.backfill_rollups()
+        self.assertEqual(self.totals('user'), self.expected('user'))
+        data.backfill_rollups()
+        self.assertEqual(self.totals('user'), self.expected('user'))
+
+
+class TwoProcessTest(unittest.TestCase):
+    """Two processes opening the same older DB at once."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_uri = 'sqlite:///{0}'.format(
+            os.path.join(self.directory, 'infoboard.db'))
+        DBSession.remove()
+        data.entity_cache.clear()
+        data.migrate(data.setup(self.db_uri))
+        self.org = SyntheticOrg(members=5, repos=3, mix={'PushEvent': 1})
+        events = self.org.generate(500, spread=timedelta(days=20))
+        for event in events:
+            for commit in event['payload']['commits']:
+                commit['message'] = 'Show &lt;b&gt; as it is'
+        data.ingest_events(events)
+
+    def tearDown(self):
+        DBSession.remove()
+        data.entity_cache.clear()
+        shutil.rmtree(self.directory)
+
+    def run_twice(self, script):
+        """Run `script` in two processes at once, with `data` set up."""
+        script = 'import data\nengine = data.setup({0!r})\n{1}'.format(
+            self.db_uri, script)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        with open(os.devnull, 'w') as devnull:
+            processes = [subprocess.Popen([sys.executable, '-c', script],
+                                          env=env, stdout=devnull,
+                                          stderr=subprocess.PIPE)
+                         for _ in range(2)]
+            for process in processes:
+                _, errors = process.communicate()
+                self.assertEqual(process.returncode, 0, errors)
+        DBSession.remove()
+        data.entity_cache.clear()
+
+    def test_setup_leaves_data_alone(self):
+        escape_everything()
+        DBSession.remove()
+        self.run_twice('')
+        for event in data.recent_events():
+            for commit in event['payload']['commits']:
+                self.assertEqual(commit['message'],
+                                 'Show &amp;lt;b&amp;gt; as it is')
+
+    def test_migrated_once(self):
+        escape_everything()
+        DBSession.remove()
+        self.run_twice('data.migrate(engine)')
+        for event in data.recent_events():
+            for commit in event['payload']['commits']:
+                self.assertEqual(commit['message'], 'Show &lt;b&gt; as it is')
+
+    def test_unescaped_once(self):
+        escape_everything()
+        DBSession.remove()
+        self.run_twice('data.unescape_facts()')
+        for event in data.recent_events():
+            for commit in event['payload']['commits']:
+                self.assertEqual(commit['message'], 'Show &lt;b&gt; as it is')
+
+    def test_rolled_up_once(self):
+        DBSession.query(Contribution).delete()
+        DBSession.query(Rollup).delete()
+        DBSession.query(State).filter(State.key == 'rolled_up').delete()
+        DBSession.commit()
+        DBSession.remove()
+        self.run_twice('data.backfill_rollups()\n'
+                       'data.rebuild_contributions()')
+        totals = dict()
+        for event in data.recent_events():
+            for kind, key, detail, changes in data._contributions(
+                    event, event['payload']):
+                if kind == 'user' and detail == 'count':
+                    totals[key] = round(totals.get(key, 0) + changes, 6)
+        counted = dict()
+        for table in [Contribution, Rollup]:
+            for row in DBSession.query(table).filter(table.kind == 'user') \
+                                             .filter(table.detail == 'count'):
+                counted[row.key] = round(counted.get(row.key, 0) + row.count,
+                                         6)
+        self.assertEqual(counted, totals)
+
+
+if __name__ == '__main__':
+    unittest.main()
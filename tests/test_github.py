@@ -0,0 +1,60 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from github import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(limit=5000)
+        self.reset = int(time.time()) + 3600
+        self.limiter.update(10, self.reset)
+
+    def test_acquire_counts_down(self):
+        self.limiter.acquire()
+        self.limiter.acquire()
+        self.assertEqual(self.limiter.remaining, 8)
+
+    def test_same_window_keeps_lower_count(self):
+        self.limiter.update(12, self.reset)
+        self.assertEqual(self.limiter.remaining, 10)
+        self.limiter.update(7, self.reset)
+        self.assertEqual(self.limiter.remaining, 7)
+
+    def test_new_window_trusts_github(self):
+        self.limiter.update(5000, self.reset + 3600)
+        self.assertEqual(self.limiter.remaining, 5000)
+
+    def test_uncharged_requests_are_given_back(self):
+        # Many more 304s than the budget, which Github never charges for.
+        for _ in range(100):
+            self.limiter.acquire()
+            self.limiter.update(10, self.reset)
+            self.limiter.release()
+        self.assertEqual(self.limiter.remaining, 10)
+
+    def test_release_wakes_waiters(self):
+        self.limiter.update(0, self.reset)
+        done = threading.Event()
+
+        def wait():
+            self.limiter.acquire()
+            done.set()
+        waiter = threading.Thread(target=wait)
+        waiter.daemon = True
+        waiter.start()
+        self.assertFalse(done.wait(0.1))
+        self.limiter.release()
+        self.assertTrue(done.wait(1))
+
+    def test_lets_one_through_after_reset(self):
+        self.limiter.update(0, int(time.time()) - 1)
+        self.limiter.acquire()
+        self.assertEqual(self.limiter.remaining, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import unittest
+
+from benchmark import FakeGithub, SyntheticOrg
+from github import Github
+from httpcache import NegativeCache, ValidatorCache
+from tests.test_data import DBTestCase
+
+
+class ValidatorCacheTest(DBTestCase):
+    url = 'https://api.github.com/users/someone/events'
+
+    def test_conditional_headers(self):
+        cache = ValidatorCache()
+        self.assertEqual(cache.conditional_headers(self.url), dict())
+        cache.store(self.url, {'etag': '"abc"',
+                               'last-modified': 'Fri, 01 Jan 2016'}, [1])
+        self.assertEqual(cache.conditional_headers(self.url),
+                         {'If-None-Match': '"abc"',
+                          'If-Modified-Since': 'Fri, 01 Jan 2016'})
+        self.assertEqual(cache.hit(self.url), [1])
+
+    def test_without_validators(self):
+        cache = ValidatorCache()
+        cache.store(self.url, dict(), [1])
+        self.assertEqual(cache.conditional_headers(self.url), dict())
+        self.assertIsNone(cache.stale(self.url))
+
+    def test_persists(self):
+        cache = ValidatorCache()
+        cache.store(self.url, {'etag': '"abc"'}, [{'id': '1'}])
+        cache.save()
+        self.assertEqual(ValidatorCache().stale(self.url), [{'id': '1'}])
+        cache.forget(self.url)
+        cache.save()
+        self.assertEqual(ValidatorCache().stats()['entries'], 0)
+
+    def test_github_reuses_payloads(self):
+        org = SyntheticOrg(members=2, repos=1)
+        org.generate(5)
+        fake = FakeGithub(org)
+        client = Github(session=fake, cache=ValidatorCache(load=False))
+        login = org.members[0]['login']
+        first = client.fetch_events(login)
+        remaining = client.limiter.remaining
+        self.assertEqual(client.fetch_events(login), first)
+        self.assertEqual(fake.stats()['by_status'], {'200': 1, '304': 1})
+        self.assertEqual(client.limiter.remaining, remaining)
+
+
+class NegativeCacheTest(DBTestCase):
+    def test_backs_off(self):
+        cache = NegativeCache(retry=timedelta(hours=1))
+        now = datetime.now()
+        cache.add('repo:gone/away', now)
+        self.assertTrue(cache.missing('repo:gone/away', now))
+        later = now + timedelta(hours=1, minutes=1)
+        self.assertFalse(cache.missing('repo:gone/away', later))
+        cache.add('repo:gone/away', later)
+        self.assertTrue(cache.missing('repo:gone/away',
+                                      later + timedelta(hours=1, minutes=1)))
+        self.assertFalse(cache.missing('repo:gone/away',
+                                       later + timedelta(hours=2, minutes=1)))
+
+    def test_backoff_is_capped(self):
+        cache = NegativeCache(retry=timedelta(hours=1),
+                              max_retry=timedelta(hours=3))
+        now = datetime.now()
+        for _ in range(10):
+            cache.add('user:ghost', now)
+        self.assertFalse(cache.missing('user:ghost',
+                                       now + timedelta(hours=3, minutes=1)))
+
+    def test_persists(self):
+        cache = NegativeCache()
+        cache.add('repo:gone/away')
+        cache.add('user:ghost')
+        cache.save()
+        self.assertTrue(NegativeCache().missing('repo:gone/away'))
+        cache.remove('user:ghost')
+        cache.save()
+        again = NegativeCache()
+        self.assertFalse(again.missing('user:ghost'))
+        self.assertEqual(again.stats()['entries'], 1)
+
+    def test_github_skips_missing(self):
+        fake = FakeGithub(SyntheticOrg(members=2, repos=1))
+        client = Github(session=fake, missing=NegativeCache(load=False))
+        self.assertIsNone(client.fetch_repo('BenchOrg/gone'))
+        self.assertIsNone(client.fetch_repo('BenchOrg/gone'))
+        self.assertEqual(list(client.fetch_feeds(['ghost', 'ghost'])),
+                         [('ghost', []), ('ghost', [])])
+        self.assertEqual(fake.stats()['by_status'], {'404': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        metrics.values.clear()
+        metrics.types.clear()
+
+    def test_render(self):
+        metrics.count('requests_total', status=200)
+        metrics.count('requests_total', 2, status=200)
+        metrics.gauge('remaining', 42)
+        metrics.observe('seconds', 0.5, kind='a"b')
+        self.assertEqual(metrics.render(), '\n'.join([
+            '# TYPE remaining gauge',
+            'remaining 42',
+            '# TYPE requests_total counter',
+            'requests_total{status="200"} 3',
+            '# TYPE seconds summary',
+            'seconds_count{kind="a\\"b"} 1',
+            'seconds_sum{kind="a\\"b"} 0.5',
+        ]) + '\n')
+
+    def test_timed(self):
+        @metrics.timed('call_seconds')
+        def call():
+            return 'done'
+        self.assertEqual(call(), 'done')
+        self.assertEqual(metrics.values[('call_seconds_count', ())], 1)
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'infoboard.prom')
+            metrics.gauge('remaining', 1)
+            metrics.write(path)
+            with open(path) as metrics_file:
+                self.assertEqual(metrics_file.read(), metrics.render())
+            self.assertEqual(os.listdir(directory), ['infoboard.prom'])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
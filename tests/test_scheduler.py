@@ -0,0 +1,54 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(min_interval=60, max_interval=600)
+
+    def test_idle_members_back_off(self):
+        event = [dict(id='1')]
+        self.scheduler.record('idle', event, now=1000)
+        self.assertEqual(self.scheduler.next_poll['idle'], 1060)
+        self.scheduler.record('idle', event, now=1060)
+        self.assertEqual(self.scheduler.next_poll['idle'], 1180)
+        for _ in range(10):
+            self.scheduler.record('idle', event, now=2000)
+        self.assertEqual(self.scheduler.next_poll['idle'], 2600)
+
+    def test_activity_resets_the_interval(self):
+        for _ in range(5):
+            self.scheduler.record('busy', [dict(id='1')], now=1000)
+        self.scheduler.record('busy', [dict(id='2')], now=1000)
+        self.assertEqual(self.scheduler.next_poll['busy'], 1060)
+        self.scheduler.record('busy', [], now=1000)
+        self.scheduler.active('busy', now=1000)
+        self.assertEqual(self.scheduler.next_poll['busy'], 1060)
+
+    def test_poll_interval_is_respected(self):
+        self.scheduler.record('someone', [dict(id='1')], poll_interval=300,
+                              now=1000)
+        self.assertEqual(self.scheduler.next_poll['someone'], 1300)
+
+    def test_due(self):
+        self.scheduler.record('later', [], now=1000)
+        self.scheduler.record('sooner', [dict(id='1')], now=900)
+        self.assertEqual(self.scheduler.due(['later', 'sooner', 'new'],
+                                            now=1100),
+                         ['new', 'sooner'])
+        self.assertEqual(self.scheduler.due(['later', 'sooner', 'new'],
+                                            now=2000, limit=2),
+                         ['new', 'sooner'])
+
+    def test_budget_spreads_the_limit(self):
+        # 900 usable calls over an hour of 60 second cycles.
+        self.assertEqual(self.scheduler.budget(1000, 3601, now=1), 15)
+        self.assertEqual(self.scheduler.budget(0, 3601, now=1), 1)
+        self.assertEqual(self.scheduler.budget(1000, 0, now=10), 900)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import unittest
+
+from benchmark import FakeGithub, SyntheticOrg
+from github import Github
+from httpcache import ValidatorCache
+from scheduler import Scheduler
+from tests.test_data import DBTestCase
+import data
+import scraper
+
+
+class ScraperTest(DBTestCase):
+    def setUp(self):
+        super(ScraperTest, self).setUp()
+        self.org = SyntheticOrg(members=10, repos=4)
+        self.org.generate(100, spread=timedelta(days=1))
+        self.fake = FakeGithub(self.org)
+        self.client = Github(session=self.fake,
+                             cache=ValidatorCache(load=False))
+        self.scheduler = Scheduler()
+
+    def test_feeds_are_limited(self):
+        read = scraper.cache_events(self.client, self.org.name,
+                                    scheduler=self.scheduler, limit=3)
+        self.assertEqual(read, 3)
+        self.assertEqual(len(data.get_states('feed:')), 3)
+
+    def test_org_feed_counts_against_the_limit(self):
+        # Only a few members are in the organization's feed.
+        self.org.org_feed = self.org.org_feed[:2]
+        read = scraper.cache_org_events(self.client, self.org.name,
+                                        self.scheduler, fallback=5, limit=3)
+        self.assertEqual(read, 3)
+
+    def test_refresh_within_limit(self):
+        scraper.cache_events(self.client, self.org.name,
+                             scheduler=self.scheduler)
+        self.assertEqual(scraper.refresh_repos(self.client, timedelta(0),
+                                               limit=0), 0)
+        self.assertEqual(scraper.refresh_repos(self.client, timedelta(0),
+                                               limit=2), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
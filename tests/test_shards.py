@@ -0,0 +1,73 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from httpcache import NegativeCache, ValidatorCache
+import shards
+from shards import TokenPool
+from tests.test_data import DBTestCase
+
+FEED = 'https://api.github.com/users/{0}/events'
+
+
+def _entries():
+    """Run in a worker: everything its caches hold."""
+    return (dict(shards.client.cache.entries),
+            dict(shards.client.missing.entries)), shards._report()
+
+
+def _learn(login):
+    """Run in a worker: as if `login`'s feed had been read, and a
+       repository found missing.
+    """
+    shards.client.cache.store(FEED.format(login), {'etag': '"new"'}, [2])
+    shards.client.missing.add('repo:{0}/gone'.format(login))
+    return None, shards._report()
+
+
+class TokenPoolTest(DBTestCase):
+    def setUp(self):
+        super(TokenPoolTest, self).setUp()
+        self.pool = TokenPool([('one', 'x'), ('two', 'y')], threads=1)
+
+    def tearDown(self):
+        for pool in self.pool.pools:
+            pool.terminate()
+        super(TokenPoolTest, self).tearDown()
+
+    def test_workers_get_their_shard(self):
+        cache = ValidatorCache()
+        logins = ['login{0}'.format(number) for number in range(20)]
+        for login in logins:
+            cache.store(FEED.format(login), {'etag': '"old"'}, [1])
+        cache.store('https://api.github.com/orgs/some/members',
+                    {'etag': '"old"'}, [])
+        cache.save()
+        missing = NegativeCache()
+        missing.add('user:ghost')
+        self.pool.load_caches(cache, missing)
+
+        for index, pool in enumerate(self.pool.pools):
+            (validators, misses), _ = pool.apply(_entries)
+            self.assertIn('https://api.github.com/orgs/some/members',
+                          validators)
+            for login in logins:
+                self.assertEqual(FEED.format(login) in validators,
+                                 self.pool._index(login) == index)
+            self.assertEqual('user:ghost' in misses,
+                             self.pool._index('ghost') == index)
+        # Handing them out doesn't send them back to be saved again.
+        self.assertEqual(cache.changes()[0], dict())
+
+    def test_what_workers_learn_is_saved(self):
+        self.pool.load_caches(ValidatorCache(), NegativeCache())
+        self.pool._call(_learn, 'someone')
+        self.pool.cache.save()
+        self.pool.missing.save()
+        self.assertEqual(ValidatorCache().stale(FEED.format('someone')), [2])
+        self.assertTrue(NegativeCache().missing('repo:someone/gone'))
+        self.assertEqual(self.pool.cache.stats()['misses'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import unittest
+
+from benchmark import SyntheticOrg
+import data
+from tests.test_data import DBTestCase
+import viewmodel
+
+
+class EventViewTest(unittest.TestCase):
+    def record(self, **details):
+        record = dict(type='PushEvent',
+                      actor=dict(name='A & B', avatar='https://x/?a=1&b=2'),
+                      repo=dict(name='org/<repo>', url='https://x/org/repo',
+                                description='Tools & things'),
+                      commits=['Fix a < b'],
+                      payload=dict())
+        record.update(details)
+        return record
+
+    def test_text_is_escaped_once(self):
+        view = viewmodel.event_view('event_1', datetime(2016, 1, 1),
+                                    self.record())
+        self.assertIn('A &amp; B pushed 1 commit(s)', view.text)
+        self.assertIn('>org/&lt;repo&gt;</a>', view.text)
+        self.assertIn('Fix a &lt; b', view.text)
+        self.assertNotIn('&amp;amp;', view.text)
+
+    def test_avatar_is_left_alone(self):
+        view = viewmodel.event_view('event_1', datetime(2016, 1, 1),
+                                    self.record())
+        self.assertEqual(view.avatar, 'https://x/?a=1&b=2')
+
+
+class CatchUpTest(DBTestCase):
+    def setUp(self):
+        super(CatchUpTest, self).setUp()
+        self.org = SyntheticOrg(members=3, repos=2)
+        data.ingest_events(self.org.generate(5, spread=timedelta(hours=2)))
+
+    def catch_up(self, snapshot, seq, full=False):
+        return viewmodel.catch_up(snapshot, seq, 10, 1, 1, full)
+
+    def test_catches_up(self):
+        snapshot, seq = self.catch_up(None, 0)
+        self.assertEqual(len(snapshot.events), 5)
+        self.assertEqual(self.catch_up(snapshot, seq), (snapshot, seq))
+
+        data.ingest_events(self.org.generate(2, spread=timedelta(0)))
+        fresh, latest = self.catch_up(snapshot, seq)
+        self.assertGreater(latest, seq)
+        self.assertEqual(len(fresh.events), 7)
+        self.assertEqual(fresh.events[2:], snapshot.events)
+
+    def test_rebuilds(self):
+        snapshot, seq = self.catch_up(None, 0)
+        fresh, latest = self.catch_up(snapshot, seq, full=True)
+        self.assertIsNot(fresh, snapshot)
+        self.assertEqual(fresh, snapshot)
+        # As if the change log had been started over.
+        fresh, latest = self.catch_up(snapshot, seq + 100)
+        self.assertIsNot(fresh, snapshot)
+        self.assertEqual(latest, seq)
+
+
+if __name__ == '__main__':
+    unittest.main()
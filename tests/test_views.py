@@ -0,0 +1,54 @@
+# -*- coding: UTF-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from views import (EventView, FILE_VERSION, HilightView, Snapshot,
+                   load_snapshot, save_snapshot)
+
+
+class SnapshotFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, contents):
+        with open(self.path, 'w') as snapshot_file:
+            snapshot_file.write(contents)
+
+    def test_round_trip(self):
+        snapshot = Snapshot(
+            (EventView('event_2', 'PushEvent', datetime(2016, 1, 2, 3, 4, 5),
+                       '#C9FFC1', 'https://x/?a=1&b=2',
+                       'Someone pushed • <tt>a &amp; b</tt>'),
+             EventView('event_1', 'WatchEvent', datetime(2016, 1, 1),
+                       '#FFFF80', None, 'Someone is watching')),
+            (HilightView('user_1', 'https://x/1', 'Busy'),),
+            (HilightView('org/repo', None, 'Cool'),))
+        save_snapshot(snapshot, self.path)
+        self.assertEqual(load_snapshot(self.path), snapshot)
+        self.assertEqual(os.listdir(self.directory), ['snapshot.json'])
+
+    def test_missing(self):
+        self.assertIsNone(load_snapshot(self.path))
+
+    def test_unusable(self):
+        for contents in ['', '{"version": 1', '[1, 2]', '"text"', 'null',
+                         json.dumps(dict(version=FILE_VERSION + 1)),
+                         json.dumps(dict(version=FILE_VERSION)),
+                         json.dumps(dict(version=FILE_VERSION,
+                                         events=[[1]], users=[], repos=[]))]:
+            self.write(contents)
+            self.assertIsNone(load_snapshot(self.path), contents)
+
+
+if __name__ == '__main__':
+    unittest.main()
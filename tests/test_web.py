@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+
+from datetime import datetime
+import json
+import threading
+import unittest
+try:
+    from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+from views import EventView, HilightView, Snapshot
+import web
+
+
+class BoardHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.board = web.Board(5, 1, 1)
+        web.BoardHandler.board = self.board
+        self.server = web.ThreadingHTTPServer(('localhost', 0),
+                                              web.BoardHandler)
+        worker = threading.Thread(target=self.server.serve_forever)
+        worker.daemon = True
+        worker.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path, headers=None):
+        url = 'http://localhost:{0}{1}'.format(self.server.server_address[1],
+                                               path)
+        try:
+            return urlopen(Request(url, headers=headers or dict()))
+        except HTTPError as e:
+            return e
+
+    def publish(self):
+        event = EventView('event_1', 'PushEvent', datetime(2016, 1, 1),
+                          '#FFFFFF', None, 'Something happened')
+        user = HilightView('user_1', None, 'Someone was busy')
+        self.board.publish(Snapshot((event,), (user,), ()))
+
+    def test_unavailable_until_published(self):
+        response = self.get('/events')
+        self.assertEqual(response.code, 503)
+        self.assertTrue(response.headers.get('Retry-After'))
+
+    def test_events(self):
+        self.publish()
+        response = self.get('/events')
+        self.assertEqual(response.code, 200)
+        events = json.loads(response.read().decode('utf-8'))
+        self.assertEqual(events[0]['name'], 'event_1')
+        self.assertEqual(events[0]['created_at'], '2016-01-01T00:00:00Z')
+
+    def test_not_modified(self):
+        self.publish()
+        etag = self.get('/').headers['ETag']
+        self.assertEqual(self.get('/', {'If-None-Match': etag}).code, 304)
+
+    def test_unknown_path(self):
+        self.publish()
+        self.assertEqual(self.get('/nothing').code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()